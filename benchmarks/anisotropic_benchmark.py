@@ -0,0 +1,92 @@
+"""Time and peak memory of the sharpness bilateral blur, single pass vs. row chunks.
+
+Usage: python benchmarks/anisotropic_benchmark.py [--device cuda] [--batch 2] [--working-mb 256]
+
+Every case runs in a fresh process so that the peak RSS reported on CPU belongs to that case only.
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+# latent sizes of 512, 1024, 1536 and 2048 pixel images
+LATENT_SIZES = [64, 128, 192, 256]
+
+
+def peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_case(queue, size, batch, device, working_bytes, repeats):
+    import torch
+    import modules.anisotropic as anisotropic
+
+    torch.manual_seed(0)
+    x = torch.randn(batch, 4, size, size, device=device)
+    g = torch.randn(batch, 4, size, size, device=device)
+
+    def filter_once():
+        return anisotropic._bilateral_blur(x, g, kernel_size=(13, 13), sigma_color=3.0, sigma_space=3.0,
+                                           border_type='reflect', color_distance_type='l1', working_bytes=working_bytes)
+
+    filter_once()  # warm up
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    else:
+        base_memory = peak_rss_bytes()
+
+    timer = time.perf_counter()
+    for _ in range(repeats):
+        y = filter_once()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - timer) / repeats
+
+    if device == 'cuda':
+        peak = torch.cuda.max_memory_allocated() - base_memory
+    else:
+        peak = peak_rss_bytes() - base_memory
+
+    reference = anisotropic._bilateral_blur(x, g, kernel_size=(13, 13), sigma_color=3.0, sigma_space=3.0,
+                                            border_type='reflect', color_distance_type='l1', working_bytes=None)
+    max_error = float((y - reference).abs().max())
+    queue.put((elapsed, peak, max_error))
+
+
+def measure(size, batch, device, working_bytes, repeats):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(queue, size, batch, device, working_bytes, repeats))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch', type=int, default=2)
+    parser.add_argument('--working-mb', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'device = {args.device}, batch = {args.batch}, working budget = {args.working_mb} MB')
+    print(f'{"image":>10} {"mode":>8} {"time (ms)":>10} {"peak (MB)":>10} {"max error":>10}')
+    for size in LATENT_SIZES:
+        for mode, working_bytes in [('single', None), ('chunked', args.working_mb * 2**20)]:
+            elapsed, peak, max_error = measure(size, args.batch, args.device, working_bytes, args.repeats)
+            print(f'{size * 8:>5}x{size * 8:<4} {mode:>8} {elapsed * 1000:>10.1f} {peak / 2**20:>10.1f} {max_error:>10.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Load time of core.load_model from the original checkpoint against its snapshot.
+
+Usage: python benchmarks/model_snapshot_benchmark.py --checkpoint models/checkpoints/sd_xl_base_1.0_0.9vae.safetensors
+       python benchmarks/model_snapshot_benchmark.py --checkpoint models/checkpoints/some_model.ckpt --mode ckpt
+
+The snapshot is written to a temporary folder unless --cache is given. Both files are read once before timing,
+so the numbers compare parsing and conversion with a warm page cache; drop the caches to measure cold reads.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root)
+sys.path.append(os.path.join(root, 'repositories', 'ComfyUI'))
+
+import torch
+import modules.core as core
+import modules.model_snapshot as model_snapshot
+
+
+def warm(filename):
+    with open(filename, 'rb', buffering=0) as f:
+        while f.read(64 * 2**20):
+            pass
+
+
+def measure(filename, repeats):
+    results = []
+    for _ in range(repeats):
+        timer = time.perf_counter()
+        sd = core.load_model(filename)
+        results.append(time.perf_counter() - timer)
+        del sd
+    return min(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--mode', type=str, default='all', choices=model_snapshot.snapshot_modes)
+    parser.add_argument('--cache', type=str, default=None)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    temp_dir = None
+    cache_path = args.cache
+    if cache_path is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        cache_path = temp_dir.name
+
+    core.model_snapshot_mode = None
+    warm(args.checkpoint)
+    original = measure(args.checkpoint, args.repeats)
+
+    timer = time.perf_counter()
+    snapshot = model_snapshot.get_snapshot(cache_path, args.checkpoint, args.mode)
+    conversion = time.perf_counter() - timer
+    if snapshot == args.checkpoint:
+        print(f'{args.checkpoint} needs no snapshot in mode "{args.mode}" (dtype {model_snapshot.target_dtype()})')
+    else:
+        core.model_snapshot_mode = args.mode
+        core.model_snapshot_path = cache_path
+        warm(snapshot)
+        loaded = measure(args.checkpoint, args.repeats)
+
+        print(f'{"file":>10} {"size (MB)":>10} {"load (s)":>10} {"speedup":>8}')
+        print(f'{"original":>10} {os.path.getsize(args.checkpoint) / 2**20:>10.0f} {original:>10.3f} {1.0:>8.2f}')
+        print(f'{"snapshot":>10} {os.path.getsize(snapshot) / 2**20:>10.0f} {loaded:>10.3f} {original / loaded:>8.2f}')
+        if loaded < original:
+            print(f'One-time conversion: {conversion:.2f}s, paid back after {conversion / (original - loaded):.1f} loads')
+        else:
+            print(f'One-time conversion: {conversion:.2f}s, not paid back')
+
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,107 @@
+"""Time of load_from_virtual_memory on CPU against the number of loader threads, and in mmap mode.
+
+Usage: python benchmarks/virtual_memory_benchmark.py --checkpoint models/checkpoints/sd_xl_base_1.0_0.9vae.safetensors
+       python benchmarks/virtual_memory_benchmark.py --synthetic-mb 2048
+
+The model is an empty module tree with the keys under --prefix, so nothing is materialized before loading.
+The first run reads the file into the page cache; drop the caches between runs to measure cold reads.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import torch
+import modules.virtual_memory as virtual_memory
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+THREADS = [1, 2, 4, 8, 16]
+
+
+def make_synthetic(filename, size_mb, prefix):
+    # Blocks of SDXL-like attention and feed-forward weights in fp16.
+    tensors = {}
+    total = 0
+    block = 0
+    while total < size_mb * 2**20:
+        for name, shape in [('to_q', (1280, 1280)), ('to_k', (1280, 1280)), ('to_v', (1280, 1280)),
+                            ('to_out', (1280, 1280)), ('ff_in', (10240, 1280)), ('ff_out', (1280, 5120)), ('norm', (1280, ))]:
+            tensors[f'{prefix}.blocks.{block}.{name}.weight'] = torch.randn(shape, dtype=torch.float16)
+            total += tensors[f'{prefix}.blocks.{block}.{name}.weight'].numel() * 2
+        block += 1
+    save_file(tensors, filename)
+
+
+def make_skeleton(filename, prefix):
+    with safe_open(filename, framework="pt", device='cpu') as f:
+        keys = [k[len(prefix) + 1:] for k in f.keys() if k.startswith(prefix + '.')]
+
+    model = torch.nn.Module()
+    for key in keys:
+        node = model
+        for name in key.split('.')[:-1]:
+            if not hasattr(node, name):
+                setattr(node, name, torch.nn.Module())
+            node = getattr(node, name)
+
+    model.model_file = dict(filename=filename, prefix=prefix, original_device='cpu')
+    return model, keys
+
+
+def measure(model, keys, prefix, threads, repeats):
+    virtual_memory.load_threads = threads
+    results = []
+    for _ in range(repeats):
+        model.virtual_memory_dict = {k: (prefix + '.' + k, torch.device('cpu'), None) for k in keys}
+        timer = time.perf_counter()
+        virtual_memory.load_from_virtual_memory(model)
+        results.append(time.perf_counter() - timer)
+        for k in keys:
+            virtual_memory.recursive_del(model, k)
+    return min(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--prefix', type=str, default='model')
+    parser.add_argument('--synthetic-mb', type=int, default=2048)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    temp_dir = None
+    filename = args.checkpoint
+    if filename is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(temp_dir.name, 'synthetic.safetensors')
+        make_synthetic(filename, args.synthetic_mb, args.prefix)
+
+    model, keys = make_skeleton(filename, args.prefix)
+    size = os.path.getsize(filename)
+    print(f'{filename}: {len(keys)} tensors under "{args.prefix}", file size = {size / 2**20:.0f} MB')
+    print(f'{"threads":>8} {"time (s)":>10} {"speedup":>8}')
+
+    baseline = None
+    for threads in THREADS:
+        elapsed = measure(model, keys, args.prefix, threads, args.repeats)
+        baseline = elapsed if baseline is None else baseline
+        print(f'{threads:>8} {elapsed:>10.3f} {baseline / elapsed:>8.2f}')
+
+    virtual_memory.mmap_mode = True
+    elapsed = measure(model, keys, args.prefix, 1, args.repeats)
+    virtual_memory.mmap_mode = False
+    print(f'{"mmap":>8} {elapsed:>10.3f} {baseline / elapsed:>8.2f}')
+
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,18 @@ Device = torch.DeviceObjType
 Dtype = torch.Type
 pad = torch.nn.functional.pad
 
+# Upper bound for the unfolded (B, C, rows, W, Ky x Kx) temporaries of the bilateral blur; None processes all rows at once.
+max_working_bytes = 256 * 2**20
+
+# Edge-preserving filter used by adaptive_anisotropic_filter: 'bilateral' (13x13 joint bilateral blur)
+# or 'guided' (guided filter built from box filters, constant cost per pixel).
+filter_type = 'bilateral'
+guided_radius = 6
+guided_eps = 1.0
+
+# Space kernels only depend on (kernel size, sigma, device, dtype) and are reused by every sampling step.
+space_kernel_cache = {}
+
 
 def _compute_zero_padding(kernel_size: tuple[int, int] | int) -> tuple[int, int]:
     ky, kx = _unpack_2d_ks(kernel_size)
@@ -72,6 +84,56 @@ def get_gaussian_kernel2d(
     return kernel_y * kernel_x.view(-1, 1, ksize_x)
 
 
+def get_space_kernel(
+    kernel_size: tuple[int, int] | int,
+    sigma_space: tuple[float, float] | Tensor,
+    device: Device,
+    dtype: Dtype,
+) -> Tensor:
+    ky, kx = _unpack_2d_ks(kernel_size)
+    if isinstance(sigma_space, Tensor):
+        return get_gaussian_kernel2d(kernel_size, sigma_space, device=device, dtype=dtype).view(-1, 1, 1, 1, kx * ky)
+
+    key = (ky, kx, sigma_space, str(device), dtype)
+    space_kernel = space_kernel_cache.get(key, None)
+    if space_kernel is None:
+        space_kernel = get_gaussian_kernel2d(kernel_size, sigma_space, device=device, dtype=dtype).view(-1, 1, 1, 1, kx * ky)
+        space_kernel_cache[key] = space_kernel
+    return space_kernel
+
+
+def _bilateral_blur_rows(
+    padded_input: Tensor,
+    padded_guidance: Tensor,
+    guidance: Tensor,
+    ky: int,
+    kx: int,
+    sigma_color: float | Tensor,
+    space_kernel: Tensor,
+    color_distance_type: str,
+) -> Tensor:
+
+    unfolded_input = padded_input.unfold(2, ky, 1).unfold(3, kx, 1).flatten(-2)  # (B, C, H, W, Ky x Kx)
+
+    if padded_guidance is padded_input:
+        unfolded_guidance = unfolded_input
+    else:
+        unfolded_guidance = padded_guidance.unfold(2, ky, 1).unfold(3, kx, 1).flatten(-2)  # (B, C, H, W, Ky x Kx)
+
+    diff = unfolded_guidance - guidance.unsqueeze(-1)
+    if color_distance_type == "l1":
+        color_distance_sq = diff.abs().sum(1, keepdim=True).square()
+    elif color_distance_type == "l2":
+        color_distance_sq = diff.square().sum(1, keepdim=True)
+    else:
+        raise ValueError("color_distance_type only acceps l1 or l2")
+    color_kernel = (-0.5 / sigma_color**2 * color_distance_sq).exp()  # (B, 1, H, W, Ky x Kx)
+
+    kernel = space_kernel * color_kernel
+    out = (unfolded_input * kernel).sum(-1) / kernel.sum(-1)
+    return out
+
+
 def _bilateral_blur(
     input: Tensor,
     guidance: Tensor | None,
@@ -80,6 +142,7 @@ def _bilateral_blur(
     sigma_space: tuple[float, float] | Tensor,
     border_type: str = 'reflect',
     color_distance_type: str = 'l1',
+    working_bytes: int | None = None,
 ) -> Tensor:
 
     if isinstance(sigma_color, Tensor):
@@ -89,29 +152,34 @@ def _bilateral_blur(
     pad_y, pad_x = _compute_zero_padding(kernel_size)
 
     padded_input = pad(input, (pad_x, pad_x, pad_y, pad_y), mode=border_type)
-    unfolded_input = padded_input.unfold(2, ky, 1).unfold(3, kx, 1).flatten(-2)  # (B, C, H, W, Ky x Kx)
 
     if guidance is None:
         guidance = input
-        unfolded_guidance = unfolded_input
+        padded_guidance = padded_input
     else:
         padded_guidance = pad(guidance, (pad_x, pad_x, pad_y, pad_y), mode=border_type)
-        unfolded_guidance = padded_guidance.unfold(2, ky, 1).unfold(3, kx, 1).flatten(-2)  # (B, C, H, W, Ky x Kx)
-
-    diff = unfolded_guidance - guidance.unsqueeze(-1)
-    if color_distance_type == "l1":
-        color_distance_sq = diff.abs().sum(1, keepdim=True).square()
-    elif color_distance_type == "l2":
-        color_distance_sq = diff.square().sum(1, keepdim=True)
-    else:
-        raise ValueError("color_distance_type only acceps l1 or l2")
-    color_kernel = (-0.5 / sigma_color**2 * color_distance_sq).exp()  # (B, 1, H, W, Ky x Kx)
 
-    space_kernel = get_gaussian_kernel2d(kernel_size, sigma_space, device=input.device, dtype=input.dtype)
-    space_kernel = space_kernel.view(-1, 1, 1, 1, kx * ky)
+    space_kernel = get_space_kernel(kernel_size, sigma_space, device=input.device, dtype=input.dtype)
 
-    kernel = space_kernel * color_kernel
-    out = (unfolded_input * kernel).sum(-1) / kernel.sum(-1)
+    # Every output row only depends on Ky padded rows, so rows can be processed in chunks
+    # with exactly the same arithmetic per pixel as the single pass.
+    B, C, H, W = input.shape
+    if working_bytes is None:
+        rows = H
+    else:
+        bytes_per_row = B * W * kx * ky * input.element_size() * (3 * C + 3)
+        rows = max(1, working_bytes // bytes_per_row)
+
+    if rows >= H:
+        return _bilateral_blur_rows(padded_input, padded_guidance, guidance, ky, kx, sigma_color, space_kernel, color_distance_type)
+
+    out = torch.empty_like(input)
+    for r0 in range(0, H, rows):
+        r1 = min(H, r0 + rows)
+        chunk_input = padded_input[:, :, r0:r1 + ky - 1]
+        chunk_guidance = chunk_input if padded_guidance is padded_input else padded_guidance[:, :, r0:r1 + ky - 1]
+        out[:, :, r0:r1] = _bilateral_blur_rows(chunk_input, chunk_guidance, guidance[:, :, r0:r1], ky, kx,
+                                                sigma_color, space_kernel, color_distance_type)
     return out
 
 
@@ -126,18 +194,52 @@ def bilateral_blur(
     return _bilateral_blur(input, None, kernel_size, sigma_color, sigma_space, border_type, color_distance_type)
 
 
+def _box_filter(x: Tensor, r: int) -> Tensor:
+    # Mean over a (2r+1) x (2r+1) window with reflected borders, from summed-area tables.
+    k = 2 * r + 1
+    padded = pad(x, (r + 1, r, r + 1, r), mode='reflect')
+    padded[:, :, 0, :] = 0
+    padded[:, :, :, 0] = 0
+    integral = padded.cumsum(2).cumsum(3)
+    box = integral[:, :, k:, k:] - integral[:, :, :-k, k:] - integral[:, :, k:, :-k] + integral[:, :, :-k, :-k]
+    return box / (k * k)
+
+
+def guided_filter(input: Tensor, guidance: Tensor, radius: int, eps: float) -> Tensor:
+    # Per-channel guided filter (He et al.): q = mean(a) * I + mean(b) with a = cov(I, p) / (var(I) + eps).
+    dtype = input.dtype
+    p = input.float()
+    i = guidance.float()
+    if i.shape[1] != p.shape[1]:
+        i = i.mean(dim=1, keepdim=True).expand_as(p)
+
+    mean_i = _box_filter(i, radius)
+    mean_p = _box_filter(p, radius)
+    cov_ip = _box_filter(i * p, radius) - mean_i * mean_p
+    var_i = _box_filter(i * i, radius) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+
+    q = _box_filter(a, radius) * i + _box_filter(b, radius)
+    return q.to(dtype)
+
+
 def adaptive_anisotropic_filter(x, g=None):
     if g is None:
         g = x
     s, m = torch.std_mean(g, dim=(1, 2, 3), keepdim=True)
     s = s + 1e-5
     guidance = (g - m) / s
+    if filter_type == 'guided':
+        return guided_filter(x, guidance, radius=guided_radius, eps=guided_eps)
     y = _bilateral_blur(x, guidance,
                         kernel_size=(13, 13),
                         sigma_color=3.0,
                         sigma_space=3.0,
                         border_type='reflect',
-                        color_distance_type='l1')
+                        color_distance_type='l1',
+                        working_bytes=max_working_bytes)
     return y
 
 
@@ -1,18 +1,41 @@
 import threading
+import queue
+import itertools
 
 
-buffer = []
-outputs = []
+class AsyncTask:
+    _job_ids = itertools.count(1)
+
+    def __init__(self, args):
+        self.job_id = next(AsyncTask._job_ids)
+        self.args = args
+        self.yields = queue.Queue()  # (flag, product) events, consumed only by the session that submitted the job
+
+    def put(self, flag, product):
+        self.yields.put((flag, product))
+
+    def get(self, timeout=None):
+        return self.yields.get(timeout=timeout)
+
+
+async_tasks = queue.Queue()
+
+
+def submit(args):
+    task = AsyncTask(args=list(args))
+    async_tasks.put(task)
+    return task
 
 
 def worker():
-    global buffer, outputs
+    global async_tasks
 
     import os
     import json
     import numpy as np
     import torch
     import time
+    import traceback
     import shared
     import random
     import copy
@@ -59,14 +82,14 @@ def worker():
         return image
 
 
-    def progressbar(number, text):
-        print(f'[Fooocus] {text}')
-        outputs.append(['preview', (number, text, None)])
+    def progressbar(async_task, number, text):
+        print(f'[Fooocus] [Job {async_task.job_id}] {text}')
+        async_task.put('preview', (number, text, None))
 
 
     @torch.no_grad()
     @torch.inference_mode()
-    def handler(task):
+    def handler(async_task):
         prompt, negative_prompt, style_selections, performance, resolution, image_number, image_seed, \
         sharpness, sampler_name, scheduler, custom_steps, custom_switch, cfg, \
         base_model_name, refiner_model_name, base_clip_skip, refiner_clip_skip, \
@@ -80,7 +103,7 @@ def worker():
         freeu, freeu_b1, freeu_b2, freeu_s1, freeu_s2, \
         input_image_checkbox, current_tab, \
         uov_method, uov_input_image, outpaint_selections, inpaint_input_image, \
-        use_style_iterator, input_gallery, revision_gallery, keep_input_names = task
+        use_style_iterator, input_gallery, revision_gallery, keep_input_names = async_task.args
 
         outpaint_selections = [o.lower() for o in outpaint_selections]
 
@@ -95,6 +118,8 @@ def worker():
         uov_method = uov_method.lower()
 
         modules.patch.sharpness = sharpness
+        modules.patch.sharpness_skip_threshold = float(default_settings['sharpness_skip_threshold'])
+        modules.patch.sharpness_steps.update(filtered=0, skipped=0)
         modules.patch.negative_adm = True
         initial_latent = None
         denoising_strength = 1.0
@@ -126,7 +151,8 @@ def worker():
 
 
         if input_image_checkbox:
-            progressbar(0, 'Image processing ...')
+            pipeline.wait_for_startup('models', lambda status: progressbar(async_task, 0, f'Waiting for startup: {status} ...'))
+            progressbar(async_task, 0, 'Image processing ...')
             if current_tab == 'uov' and uov_method != flags.disabled and uov_input_image is not None:
                 uov_input_image = HWC3(uov_input_image)
                 if 'vary' in uov_method:
@@ -140,7 +166,7 @@ def worker():
                     if 'strong' in uov_method:
                         denoising_strength = 0.85
                     initial_pixels = core.numpy_to_pytorch(uov_input_image)
-                    progressbar(0, 'VAE encoding ...')
+                    progressbar(async_task, 0, 'VAE encoding ...')
                     initial_latent = core.encode_vae(vae=pipeline.xl_base_patched.vae, pixels=initial_pixels)
                     B, C, H, W = initial_latent['samples'].shape
                     width = W * 8
@@ -148,7 +174,7 @@ def worker():
                     print(f'Final resolution is {str((height, width))}.')
                 elif 'upscale' in uov_method:
                     H, W, C = uov_input_image.shape
-                    progressbar(0, f'Upscaling image from {str((H, W))} ...')
+                    progressbar(async_task, 0, f'Upscaling image from {str((H, W))} ...')
 
                     uov_input_image = core.numpy_to_pytorch(uov_input_image)
                     uov_input_image = perform_upscale(uov_input_image)
@@ -188,7 +214,7 @@ def worker():
                     if direct_return:
                         d = [('Upscale (Fast)', '2x')]
                         log(uov_input_image, d, single_line_number=1, output_format=output_format)
-                        outputs.append(['results', [uov_input_image]])
+                        async_task.put('results', [uov_input_image])
                         return
 
                     tiled = True
@@ -196,7 +222,7 @@ def worker():
                     steps = int(steps * 0.618)
                     switch = int(steps * 0.67)
                     initial_pixels = core.numpy_to_pytorch(uov_input_image)
-                    progressbar(0, 'VAE encoding ...')
+                    progressbar(async_task, 0, 'VAE encoding ...')
 
                     initial_latent = core.encode_vae(vae=pipeline.xl_base_patched.vae, pixels=initial_pixels, tiled=True)
                     B, C, H, W = initial_latent['samples'].shape
@@ -233,15 +259,15 @@ def worker():
                                                                                is_outpaint=len(outpaint_selections) > 0)
 
                     # print(f'Inpaint task: {str((height, width))}')
-                    # outputs.append(['results', inpaint_worker.current_task.visualize_mask_processing()])
+                    # async_task.put('results', inpaint_worker.current_task.visualize_mask_processing())
                     # return
 
-                    progressbar(0, 'Downloading inpainter ...')
+                    progressbar(async_task, 0, 'Downloading inpainter ...')
                     inpaint_head_model_path, inpaint_patch_model_path = modules.path.downloading_inpaint_models()
                     loras += [(inpaint_patch_model_path, 1.0)]
 
                     inpaint_pixels = core.numpy_to_pytorch(inpaint_worker.current_task.image_ready)
-                    progressbar(0, 'VAE encoding ...')
+                    progressbar(async_task, 0, 'VAE encoding ...')
                     initial_latent = core.encode_vae(vae=pipeline.xl_base_patched.vae, pixels=inpaint_pixels)
                     inpaint_latent = initial_latent['samples']
                     B, C, H, W = inpaint_latent.shape
@@ -250,7 +276,7 @@ def worker():
                     inpaint_mask = torch.nn.functional.interpolate(inpaint_mask, (H, W), mode='bilinear')
                     inpaint_worker.current_task.load_latent(latent=inpaint_latent, mask=inpaint_mask)
 
-                    progressbar(0, 'VAE inpaint encoding ...')
+                    progressbar(async_task, 0, 'VAE inpaint encoding ...')
 
                     inpaint_mask = (inpaint_worker.current_task.mask_ready > 0).astype(np.float32)
                     inpaint_mask = torch.tensor(inpaint_mask).float()
@@ -279,7 +305,7 @@ def worker():
             revision_mode = False
 
 
-        progressbar(1, 'Initializing ...')
+        progressbar(async_task, 1, 'Initializing ...')
 
         raw_prompt = prompt
         raw_negative_prompt = negative_prompt
@@ -301,7 +327,8 @@ def worker():
             seed = random.randint(constants.MIN_SEED, constants.MAX_SEED)
 
 
-        progressbar(3, 'Loading models ...')
+        pipeline.wait_for_startup('models', lambda status: progressbar(async_task, 3, f'Waiting for startup: {status} ...'))
+        progressbar(async_task, 3, 'Loading models ...')
         pipeline.refresh_everything(
             refiner_model_name=refiner_model_name,
             base_model_name=base_model_name,
@@ -334,7 +361,7 @@ def worker():
             revision_images_filenames = list(map(lambda path: os.path.basename(path), revision_images_paths))
             revision_strengths = [revision_strength_1, revision_strength_2, revision_strength_3, revision_strength_4]
             for i in range(revision_gallery_size):
-                progressbar(4, f'Revision for image {i + 1} ...')
+                progressbar(async_task, 4, f'Revision for image {i + 1} ...')
                 print(f'Revision for image {i+1} started')
                 if revision_strengths[i % 4] != 0:
                     revision_image = get_image(revision_images_paths[i])
@@ -347,7 +374,7 @@ def worker():
             revision_strengths = []
 
 
-        progressbar(5, 'Processing prompts ...')
+        progressbar(async_task, 5, 'Processing prompts ...')
         tasks = []
         for i in range(image_number):
             positive_basic_workloads = []
@@ -393,46 +420,46 @@ def worker():
 
 
         if use_expansion:
-            for i, t in enumerate(tasks):
-                progressbar(5, f'Preparing Fooocus text #{i + 1} ...')
-                expansion = pipeline.expansion(t['prompt'], t['task_seed'])
+            pipeline.wait_for_startup('expansion', lambda status: progressbar(async_task, 5, f'Waiting for startup: {status} ...'))
+            pipeline.refresh_expansion()
+            progressbar(async_task, 5, 'Preparing Fooocus text ...')
+            expansions = pipeline.expansion.expand_many([t['prompt'] for t in tasks], [t['task_seed'] for t in tasks])
+            for t, expansion in zip(tasks, expansions):
                 print(f'[Prompt Expansion] New suffix: {expansion}')
                 t['expansion'] = expansion
                 t['positive'] = copy.deepcopy(t['positive']) + [join_prompts(t['prompt'], expansion)]  # Deep copy.
 
-        for i, t in enumerate(tasks):
-            progressbar(7, f'Encoding base positive #{i + 1} ...')
-            t['c'][0] = pipeline.clip_encode(sd=pipeline.xl_base_patched, texts=t['positive'],
-                                             pool_top_k=t['positive_top_k'])
+        # all prompts of all tasks are encoded together, one text encoder batch per model
+        workloads = [(t['positive'], t['positive_top_k']) for t in tasks] + \
+                    [(t['negative'], t['negative_top_k']) for t in tasks]
 
+        progressbar(async_task, 7, 'Encoding base positive and negative ...')
+        conds = pipeline.clip_encode_many(sd=pipeline.xl_base_patched, workloads=workloads)
         for i, t in enumerate(tasks):
-            progressbar(9, f'Encoding base negative #{i + 1} ...')
-            t['uc'][0] = pipeline.clip_encode(sd=pipeline.xl_base_patched, texts=t['negative'],
-                                              pool_top_k=t['negative_top_k'])
+            t['c'][0] = conds[i]
+            t['uc'][0] = conds[len(tasks) + i]
 
         if pipeline.xl_refiner is not None:
             virtual_memory.load_from_virtual_memory(pipeline.xl_refiner.clip.cond_stage_model)
 
+            progressbar(async_task, 11, 'Encoding refiner positive and negative ...')
+            conds = pipeline.clip_encode_many(sd=pipeline.xl_refiner, workloads=workloads)
             for i, t in enumerate(tasks):
-                progressbar(11, f'Encoding refiner positive #{i + 1} ...')
-                t['c'][1] = pipeline.clip_encode(sd=pipeline.xl_refiner, texts=t['positive'],
-                                                 pool_top_k=t['positive_top_k'])
-
-            for i, t in enumerate(tasks):
-                progressbar(13, f'Encoding refiner negative #{i + 1} ...')
-                t['uc'][1] = pipeline.clip_encode(sd=pipeline.xl_refiner, texts=t['negative'],
-                                                  pool_top_k=t['negative_top_k'])
+                t['c'][1] = conds[i]
+                t['uc'][1] = conds[len(tasks) + i]
 
             virtual_memory.try_move_to_virtual_memory(pipeline.xl_refiner.clip.cond_stage_model)
 
+        print(f'[CLIP Cache] {pipeline.cond_cache}')
+
 
         for i, t in enumerate(tasks):
-            progressbar(13, f'Applying prompt strengths #{i + 1} ...')
+            progressbar(async_task, 13, f'Applying prompt strengths #{i + 1} ...')
             t['c'][0], t['c'][1] = pipeline.apply_prompt_strength(t['c'][0], t['c'][1], positive_prompt_strength)
             t['uc'][0], t['uc'][1] = pipeline.apply_prompt_strength(t['uc'][0], t['uc'][1], negative_prompt_strength)
 
         for i, t in enumerate(tasks):
-            progressbar(13, f'Applying Revision #{i + 1} ...')
+            progressbar(async_task, 13, f'Applying Revision #{i + 1} ...')
             t['c'][0] = pipeline.apply_revision(t['c'][0], revision_mode, revision_strengths, clip_vision_outputs)
 
 
@@ -442,18 +469,62 @@ def worker():
         metadata_strings = []
         all_steps = steps * image_number
 
+        # Tasks with equally shaped conditions are sampled together as one batch.
+        # Tasks depending on input images (or a shared initial latent) are always sampled one by one.
+        sampling_batch_size = max(1, int(default_settings['sampling_batch_size']))
+        if img2img_mode or control_lora_canny or control_lora_depth or initial_latent is not None:
+            sampling_batch_size = 1
+
+        def batch_key(t):
+            return tuple(core.conditions_batch_key(c) for c in t['c'] + t['uc'])
+
+        batches = []
+        for i, t in enumerate(tasks):
+            if len(batches) > 0 and len(batches[-1]) < sampling_batch_size \
+                    and batch_key(tasks[batches[-1][0]]) == batch_key(t):
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+
+        # With a refiner, all batches can run their base steps first and then be finished by the refiner,
+        # so the base/refiner weights are swapped once per job instead of once per batch.
+        if pipeline.xl_refiner is not None and is_sdxl and default_settings['refiner_swap_per_job'] and len(batches) > 1:
+            sampling_phases = ['base', 'refiner']
+        else:
+            sampling_phases = ['full']
+        sampling_schedule = [(phase, batch_index) for phase in sampling_phases for batch_index in range(len(batches))]
+        phase_latents = {}
+        phase_execution_times = {}
+
         def callback(step, x0, x, total_steps, y):
             comfy.model_management.throw_exception_if_processing_interrupted()
-            done_steps = current_task_idx * steps + step
-            outputs.append(['preview', (
+            if phase == 'base':
+                done_steps = current_task_idx * switch + step * len(current_batch)
+            elif phase == 'refiner':
+                done_steps = image_number * switch + current_task_idx * (steps - switch) + step * len(current_batch)
+            else:
+                done_steps = current_task_idx * steps + step * len(current_batch)
+            done_steps = min(done_steps, all_steps)
+            if len(current_batch) > 1:
+                title = f'Step {step}/{total_steps} in the {current_batch[0] + 1}-{current_batch[-1] + 1}-th Sampling'
+            else:
+                title = f'Step {step}/{total_steps} in the {current_task_idx + 1}-th Sampling'
+            if phase != 'full':
+                title += f' ({phase})'
+            if isinstance(y, list):
+                y = np.concatenate(y, axis=1)
+            async_task.put('preview', (
                 int(15.0 + 85.0 * float(done_steps) / float(all_steps)),
-                f'Step {step}/{total_steps} in the {current_task_idx + 1}-th Sampling',
-                y)])
+                title,
+                y))
 
         print(f'[ADM] Negative ADM = {modules.patch.negative_adm}')
 
-        outputs.append(['preview', (13, 'Starting tasks ...', None)])
-        for current_task_idx, task in enumerate(tasks):
+        async_task.put('preview', (13, 'Starting tasks ...', None))
+        for phase, batch_index in sampling_schedule:
+            current_batch = batches[batch_index]
+            current_task_idx = current_batch[0]
+            task = tasks[current_task_idx]
             if img2img_mode or control_lora_canny or control_lora_depth:
                 input_gallery_entry = input_gallery[current_task_idx % input_gallery_size]
                 input_image_path = input_gallery_entry['name']
@@ -471,7 +542,7 @@ def worker():
                 denoise = denoising_strength
 
             input_image = None
-            if input_image_path != None:
+            if input_image_path != None and phase != 'refiner':
                 img2img_megapixels = width * height * img2img_scale ** 2 / 2**20
                 min_mp = constants.MIN_MEGAPIXELS if is_sdxl else constants.MIN_MEGAPIXELS_SD
                 max_mp = constants.MAX_MEGAPIXELS if is_sdxl else constants.MAX_MEGAPIXELS_SD
@@ -484,14 +555,24 @@ def worker():
             try:
                 execution_start_time = time.perf_counter()
 
+                if len(current_batch) > 1:
+                    batch_tasks = [tasks[i] for i in current_batch]
+                    positive_cond = [core.concat_conditions([t['c'][j] for t in batch_tasks]) for j in range(2)]
+                    negative_cond = [core.concat_conditions([t['uc'][j] for t in batch_tasks]) for j in range(2)]
+                    image_seed = [t['task_seed'] for t in batch_tasks]
+                else:
+                    positive_cond = task['c']
+                    negative_cond = task['uc']
+                    image_seed = task['task_seed']
+
                 imgs = pipeline.process_diffusion(
-                    positive_cond=task['c'],
-                    negative_cond=task['uc'],
+                    positive_cond=positive_cond,
+                    negative_cond=negative_cond,
                     steps=steps,
                     switch=switch,
                     width=width,
                     height=height,
-                    image_seed=task['task_seed'],
+                    image_seed=image_seed,
                     sampler_name=sampler_name,
                     scheduler=scheduler,
                     cfg=cfg,
@@ -509,108 +590,128 @@ def worker():
                     depth_stop=depth_stop,
                     depth_strength=depth_strength,
                     callback=callback,
-                    latent=initial_latent,
+                    latent=phase_latents.pop(batch_index) if phase == 'refiner' else initial_latent,
                     denoise=denoise,
-                    tiled=tiled)
+                    tiled=tiled,
+                    phase=phase)
+
+                execution_time = time.perf_counter() - execution_start_time + phase_execution_times.pop(batch_index, 0.0)
+
+                if phase == 'base':
+                    phase_latents[batch_index] = imgs
+                    phase_execution_times[batch_index] = execution_time
+                    continue
 
                 if inpaint_worker.current_task is not None:
                     imgs = [inpaint_worker.current_task.post_process(x) for x in imgs]
 
-                execution_time = time.perf_counter() - execution_start_time
                 print(f'Diffusion time: {execution_time:.2f} seconds')
+                print(f'[Sharpness] Filtered steps = {modules.patch.sharpness_steps["filtered"]}, '
+                      f'skipped steps = {modules.patch.sharpness_steps["skipped"]}')
     
-                metadata = {
-                    'prompt': raw_prompt, 'negative_prompt': raw_negative_prompt, 'styles': task['style_selections'],
-                    'real_prompt': task['positive'], 'real_negative_prompt': task['negative'],
-                    'seed': task['task_seed'], 'width': width, 'height': height,
-                    'sampler': sampler_name, 'scheduler': scheduler, 'performance': performance,
-                    'steps': steps, 'switch': switch, 'sharpness': sharpness, 'cfg': cfg,
-                    'base_clip_skip': base_clip_skip, 'refiner_clip_skip': refiner_clip_skip,
-                    'base_model': base_model_name, 'refiner_model': refiner_model_name,
-                    'l1': l1, 'w1': w1, 'l2': l2, 'w2': w2, 'l3': l3, 'w3': w3,
-                    'l4': l4, 'w4': w4, 'l5': l5, 'w5': w5, 'freeu': freeu,
-                    'img2img': img2img_mode, 'revision': revision_mode,
-                    'positive_prompt_strength': positive_prompt_strength, 'negative_prompt_strength': negative_prompt_strength,
-                    'control_lora_canny': control_lora_canny, 'control_lora_depth': control_lora_depth,
-                    'prompt_expansion': use_expansion
-                }
-                if freeu:
-                    metadata |= {
-                        'freeu_b1': freeu_b1, 'freeu_b2': freeu_b2, 'freeu_s1': freeu_s1, 'freeu_s2': freeu_s2
-                    }
-                if img2img_mode:
-                    metadata |= {
-                        'start_step': start_step, 'denoise': denoise, 'scale': img2img_scale, 'input_image': input_image_filename
-                    }
-                if revision_mode:
-                    metadata |= {
-                        'revision_strength_1': revision_strength_1, 'revision_strength_2': revision_strength_2,
-                        'revision_strength_3': revision_strength_3, 'revision_strength_4': revision_strength_4,
-                        'revision_images': revision_images_filenames
-                    }
-                if control_lora_canny:
-                    metadata |= {
-                        'canny_edge_low': canny_edge_low, 'canny_edge_high': canny_edge_high, 'canny_start': canny_start,
-                        'canny_stop': canny_stop, 'canny_strength': canny_strength, 'canny_model': canny_model, 'canny_input': input_image_filename
+                if len(current_batch) > 1:
+                    task_images = [(tasks[i], [x]) for i, x in zip(current_batch, imgs)]
+                else:
+                    task_images = [(task, imgs)]
+
+                for task, imgs in task_images:
+                    metadata = {
+                        'prompt': raw_prompt, 'negative_prompt': raw_negative_prompt, 'styles': task['style_selections'],
+                        'real_prompt': task['positive'], 'real_negative_prompt': task['negative'],
+                        'seed': task['task_seed'], 'width': width, 'height': height,
+                        'sampler': sampler_name, 'scheduler': scheduler, 'performance': performance,
+                        'steps': steps, 'switch': switch, 'sharpness': sharpness, 'cfg': cfg,
+                        'base_clip_skip': base_clip_skip, 'refiner_clip_skip': refiner_clip_skip,
+                        'base_model': base_model_name, 'refiner_model': refiner_model_name,
+                        'l1': l1, 'w1': w1, 'l2': l2, 'w2': w2, 'l3': l3, 'w3': w3,
+                        'l4': l4, 'w4': w4, 'l5': l5, 'w5': w5, 'freeu': freeu,
+                        'img2img': img2img_mode, 'revision': revision_mode,
+                        'positive_prompt_strength': positive_prompt_strength, 'negative_prompt_strength': negative_prompt_strength,
+                        'control_lora_canny': control_lora_canny, 'control_lora_depth': control_lora_depth,
+                        'prompt_expansion': use_expansion
                     }
-                if control_lora_depth:
-                    metadata |= {
-                        'depth_start': depth_start, 'depth_stop': depth_stop, 'depth_strength': depth_strength, 'depth_model': depth_model, 'depth_input': input_image_filename
-                    }
-                metadata |= { 'software': fooocus_version.full_version }
+                    if freeu:
+                        metadata |= {
+                            'freeu_b1': freeu_b1, 'freeu_b2': freeu_b2, 'freeu_s1': freeu_s1, 'freeu_s2': freeu_s2
+                        }
+                    if img2img_mode:
+                        metadata |= {
+                            'start_step': start_step, 'denoise': denoise, 'scale': img2img_scale, 'input_image': input_image_filename
+                        }
+                    if revision_mode:
+                        metadata |= {
+                            'revision_strength_1': revision_strength_1, 'revision_strength_2': revision_strength_2,
+                            'revision_strength_3': revision_strength_3, 'revision_strength_4': revision_strength_4,
+                            'revision_images': revision_images_filenames
+                        }
+                    if control_lora_canny:
+                        metadata |= {
+                            'canny_edge_low': canny_edge_low, 'canny_edge_high': canny_edge_high, 'canny_start': canny_start,
+                            'canny_stop': canny_stop, 'canny_strength': canny_strength, 'canny_model': canny_model, 'canny_input': input_image_filename
+                        }
+                    if control_lora_depth:
+                        metadata |= {
+                            'depth_start': depth_start, 'depth_stop': depth_stop, 'depth_strength': depth_strength, 'depth_model': depth_model, 'depth_input': input_image_filename
+                        }
+                    metadata |= { 'software': fooocus_version.full_version }
     
-                metadata_string = json.dumps(metadata, ensure_ascii=False)
-                metadata_strings.append(metadata_string)
+                    metadata_string = json.dumps(metadata, ensure_ascii=False)
+                    metadata_strings.append(metadata_string)
     
-                for x in imgs:
-                    d = [
-                        ('Prompt', raw_prompt),
-                        ('Negative Prompt', raw_negative_prompt),
-                        ('Fooocus V2 (Prompt Expansion)', task['expansion']),
-                        ('Styles', str(task['style_selections'])),
-                        ('Real Prompt', task['positive']),
-                        ('Real Negative Prompt', task['negative']),
-                        ('Seed', task['task_seed']),
-                        ('Resolution', get_resolution_string(width, height)),
-                        ('Performance', (performance, steps, switch)),
-                        ('Sampler & Scheduler', (sampler_name, scheduler)),
-                        ('Sharpness', sharpness),
-                        ('CFG & CLIP Skips', (cfg, base_clip_skip, refiner_clip_skip)),
-                        ('Base Model', base_model_name),
-                        ('Refiner Model', refiner_model_name),
-                        ('FreeU', (freeu, freeu_b1, freeu_b2, freeu_s1, freeu_s2) if freeu else (freeu)),
-                        ('Image-2-Image', (img2img_mode, start_step, denoise, img2img_scale, input_image_filename) if img2img_mode else (img2img_mode)),
-                        ('Revision', (revision_mode, revision_strength_1, revision_strength_2, revision_strength_3,
-                            revision_strength_4, revision_images_filenames) if revision_mode else (revision_mode)),
-                        ('Prompt Strengths', (positive_prompt_strength, negative_prompt_strength)),
-                        ('Canny', (control_lora_canny, canny_edge_low, canny_edge_high, canny_start, canny_stop,
-                            canny_strength, canny_model, input_image_filename) if control_lora_canny else (control_lora_canny)),
-                        ('Depth', (control_lora_depth, depth_start, depth_stop, depth_strength, depth_model, input_image_filename) if control_lora_depth else (control_lora_depth))
-                    ]
-                    for n, w in loras:
-                        if n != 'None':
-                            d.append((f'LoRA [{n}] weight', w))
-                    d.append(('Software', fooocus_version.full_version))
-                    d.append(('Execution Time', f'{execution_time:.2f} seconds'))
-                    log(x, d, 3, metadata_string, save_metadata_json, save_metadata_image, keep_input_names, input_image_filename, output_format)
-
-                results += imgs
+                    for x in imgs:
+                        d = [
+                            ('Prompt', raw_prompt),
+                            ('Negative Prompt', raw_negative_prompt),
+                            ('Fooocus V2 (Prompt Expansion)', task['expansion']),
+                            ('Styles', str(task['style_selections'])),
+                            ('Real Prompt', task['positive']),
+                            ('Real Negative Prompt', task['negative']),
+                            ('Seed', task['task_seed']),
+                            ('Resolution', get_resolution_string(width, height)),
+                            ('Performance', (performance, steps, switch)),
+                            ('Sampler & Scheduler', (sampler_name, scheduler)),
+                            ('Sharpness', sharpness),
+                            ('CFG & CLIP Skips', (cfg, base_clip_skip, refiner_clip_skip)),
+                            ('Base Model', base_model_name),
+                            ('Refiner Model', refiner_model_name),
+                            ('FreeU', (freeu, freeu_b1, freeu_b2, freeu_s1, freeu_s2) if freeu else (freeu)),
+                            ('Image-2-Image', (img2img_mode, start_step, denoise, img2img_scale, input_image_filename) if img2img_mode else (img2img_mode)),
+                            ('Revision', (revision_mode, revision_strength_1, revision_strength_2, revision_strength_3,
+                                revision_strength_4, revision_images_filenames) if revision_mode else (revision_mode)),
+                            ('Prompt Strengths', (positive_prompt_strength, negative_prompt_strength)),
+                            ('Canny', (control_lora_canny, canny_edge_low, canny_edge_high, canny_start, canny_stop,
+                                canny_strength, canny_model, input_image_filename) if control_lora_canny else (control_lora_canny)),
+                            ('Depth', (control_lora_depth, depth_start, depth_stop, depth_strength, depth_model, input_image_filename) if control_lora_depth else (control_lora_depth))
+                        ]
+                        for n, w in loras:
+                            if n != 'None':
+                                d.append((f'LoRA [{n}] weight', w))
+                        d.append(('Software', fooocus_version.full_version))
+                        d.append(('Execution Time', f'{execution_time:.2f} seconds'))
+                        log(x, d, 3, metadata_string, save_metadata_json, save_metadata_image, keep_input_names, input_image_filename, output_format)
+
+                    results += imgs
             except comfy.model_management.InterruptProcessingException as e:
                 print('User stopped')
                 break
 
-        outputs.append(['metadatas', metadata_strings])
-        outputs.append(['results', results])
+        async_task.put('metadatas', metadata_strings)
+        async_task.put('results', results)
 
         pipeline.clear_all_caches() # cleanup after generation
 
         return
 
     while True:
-        time.sleep(0.01)
-        if len(buffer) > 0:
-            task = buffer.pop(0)
-            handler(task)
+        async_task = async_tasks.get()  # blocks until a job is submitted
+        try:
+            handler(async_task)
+        except Exception as e:
+            traceback.print_exc()
+            print(f'[Fooocus] [Job {async_task.job_id}] failed: {e}')
+            async_task.put('results', [])
+        finally:
+            async_tasks.task_done()
     pass
 
 
@@ -0,0 +1,107 @@
+import os
+import hashlib
+import threading
+import torch
+
+from collections import OrderedDict
+
+
+def tensor_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(v) for v in value)
+    return 0
+
+
+def clip_identity(clip):
+    # Everything that changes the output of the text encoder for the same text:
+    # the checkpoint it was loaded from, the selected CLIP layer and the LoRAs patched into it.
+    model_file = getattr(clip.cond_stage_model, 'model_file', None)
+    if isinstance(model_file, dict):
+        model = (model_file.get('filename', None), model_file.get('prefix', None))
+    else:
+        model = ('id', id(clip.cond_stage_model))
+    layer_idx = getattr(clip, 'layer_idx', None)
+    loras = getattr(clip, 'fcs_lora_identity', ())
+    return str((model, layer_idx, loras))
+
+
+class ConditioningCache:
+    def __init__(self, max_bytes, disk_path=None):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+
+    def disk_filename(self, key):
+        return os.path.join(self.disk_path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key, None)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.disk_path is not None:
+            filename = self.disk_filename(key)
+            if os.path.exists(filename):
+                try:
+                    value = torch.load(filename, map_location='cpu')
+                    self.disk_hits += 1
+                    self.put(key, value)
+                    return value
+                except Exception as e:
+                    print(f'[CLIP Cache] Failed to read {filename}: {e}')
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        size = tensor_bytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= tensor_bytes(self.entries.pop(key))
+            self.entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self.entries) > 0:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.current_bytes -= tensor_bytes(old_value)
+                self.evictions += 1
+                self.spill(old_key, old_value)
+
+    def spill(self, key, value):
+        if self.disk_path is None:
+            return
+        filename = self.disk_filename(key)
+        if os.path.exists(filename):
+            return
+        try:
+            torch.save(value, filename)
+        except Exception as e:
+            print(f'[CLIP Cache] Failed to write {filename}: {e}')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self.entries), bytes=self.current_bytes, max_bytes=self.max_bytes)
+
+    def __str__(self):
+        return f'hits = {self.hits}, disk hits = {self.disk_hits}, misses = {self.misses}, ' \
+               f'evictions = {self.evictions}, entries = {len(self.entries)}, ' \
+               f'size = {self.current_bytes / 2**20:.1f}/{self.max_bytes / 2**20:.1f} MB'
@@ -1,10 +1,11 @@
-from modules.patch import patch_all
+from modules.patch import patch_all, register_lora_patches, forget_lora_patches
 
 patch_all()
 
 
 import os
 import random
+import threading
 import einops
 import torch
 import numpy as np
@@ -23,6 +24,10 @@ from comfy.model_base import SDXL, SDXLRefiner
 from comfy.lora import model_lora_keys_unet, model_lora_keys_clip, load_lora
 from modules.samplers_advanced import KSamplerBasic, KSamplerWithRefiner
 from modules.path import embeddings_path
+from modules.lora_bake import bake_modes, load_or_bake
+from modules.model_snapshot import get_snapshot
+from modules.model_cache import tensor_bytes
+from collections import OrderedDict
 
 
 opEmptyLatentImage = EmptyLatentImage()
@@ -40,6 +45,23 @@ opCanny = Canny()
 opFreeU = FreeU()
 opControlNetApplyAdvanced = ControlNetApplyAdvanced()
 
+# Parsed LoRA files keyed by (file, mtime, architecture). Reusing the same patch tensors when only strengths
+# change avoids reading the file again and lets calculate_weight_patched reuse the products it cached for them.
+# Bounded by entries and by the bytes of their tensors (baked files count at their full size, they are mapped).
+lora_file_cache = OrderedDict()
+lora_file_cache_entries = 8
+lora_file_cache_max_bytes = 4096 * 2**20
+lora_file_cache_bytes = 0
+
+# 'quantized' or 'fp16' keeps dense LoRA deltas in lora_bake_path (see modules.lora_bake), anything else disables it.
+lora_bake_mode = None
+lora_bake_path = None
+
+# 'ckpt' or 'all' loads checkpoints from normalized safetensors snapshots in model_snapshot_path
+# (see modules.model_snapshot), anything else loads the checkpoint files directly.
+model_snapshot_mode = None
+model_snapshot_path = None
+
 
 class StableDiffusionModel:
     def __init__(self, unet, vae, clip, clip_vision, model_filename=None):
@@ -60,8 +82,10 @@ class StableDiffusionModel:
 @torch.no_grad()
 @torch.inference_mode()
 def load_model(ckpt_filename):
-    unet, clip, vae, clip_vision = load_checkpoint_guess_config(ckpt_filename, embedding_directory=embeddings_path)
-    return StableDiffusionModel(unet=unet, clip=clip, vae=vae, clip_vision=clip_vision, model_filename=ckpt_filename)
+    # The Virtual Memory System reads the weights back from the snapshot, so .ckpt models can be offloaded too.
+    filename = get_snapshot(model_snapshot_path, ckpt_filename, model_snapshot_mode)
+    unet, clip, vae, clip_vision = load_checkpoint_guess_config(filename, embedding_directory=embeddings_path)
+    return StableDiffusionModel(unet=unet, clip=clip, vae=vae, clip_vision=clip_vision, model_filename=filename)
 
 
 @torch.no_grad()
@@ -70,20 +94,15 @@ def load_sd_lora(model, lora_filename, strength_model=1.0, strength_clip=1.0):
     if strength_model == 0 and strength_clip == 0:
         return model
 
-    lora = comfy.utils.load_torch_file(lora_filename, safe_load=False)
-
-    if lora_filename.lower().endswith('.fooocus.patch'):
-        loaded = lora
-    else:
-        key_map = model_lora_keys_unet(model.unet.model)
-        key_map = model_lora_keys_clip(model.clip.cond_stage_model, key_map)
-        loaded = load_lora(lora, key_map)
+    loaded = load_lora_patches(model, lora_filename)
 
     new_modelpatcher = model.unet.clone()
     k = new_modelpatcher.add_patches(loaded, strength_model)
 
     new_clip = model.clip.clone()
     k1 = new_clip.add_patches(loaded, strength_clip)
+    new_clip.fcs_lora_identity = getattr(model.clip, 'fcs_lora_identity', ()) + \
+        ((lora_filename, os.path.getmtime(lora_filename), strength_clip), )
 
     k = set(k)
     k1 = set(k1)
@@ -95,6 +114,43 @@ def load_sd_lora(model, lora_filename, strength_model=1.0, strength_clip=1.0):
     return StableDiffusionModel(unet=unet, clip=clip, vae=model.vae, clip_vision=model.clip_vision)
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def load_lora_patches(model, lora_filename):
+    global lora_file_cache_bytes
+    key = (os.path.abspath(lora_filename), os.path.getmtime(lora_filename),
+           type(model.unet.model).__name__, type(model.clip.cond_stage_model).__name__)
+    entry = lora_file_cache.get(key, None)
+    if entry is not None:
+        lora_file_cache.move_to_end(key)
+        return entry[0]
+
+    def parse_lora():
+        lora = comfy.utils.load_torch_file(lora_filename, safe_load=False)
+        if lora_filename.lower().endswith('.fooocus.patch'):
+            return lora
+        key_map = model_lora_keys_unet(model.unet.model)
+        key_map = model_lora_keys_clip(model.clip.cond_stage_model, key_map)
+        return load_lora(lora, key_map)
+
+    if lora_bake_mode in bake_modes and lora_bake_path is not None and not lora_filename.lower().endswith('.fooocus.patch'):
+        loaded = load_or_bake(lora_bake_path, model, lora_filename, parse_lora, lora_bake_mode)
+    else:
+        loaded = parse_lora()
+
+    size = tensor_bytes(loaded)
+    lora_file_cache[key] = (loaded, size)
+    lora_file_cache_bytes += size
+    register_lora_patches(loaded, os.path.basename(lora_filename))
+    # The newest entry stays even when it is over the budget on its own, it is in use.
+    while len(lora_file_cache) > 1 and (len(lora_file_cache) > lora_file_cache_entries or
+                                        lora_file_cache_bytes > lora_file_cache_max_bytes):
+        _, (old_loaded, old_size) = lora_file_cache.popitem(last=False)
+        lora_file_cache_bytes -= old_size
+        forget_lora_patches(old_loaded)
+    return loaded
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def load_clip_vision(ckpt_filename):
@@ -158,6 +214,29 @@ def set_conditioning_strength(conditioning, strength):
     return average(conditioning, zero_out(conditioning), strength)
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def concat_conditions(conditionings):
+    # Stacks per-sample conditionings (same token length) into one batched conditioning.
+    if len(conditionings) == 1 or conditionings[0] is None:
+        return conditionings[0]
+    result = []
+    for entries in zip(*conditionings):
+        cond = torch.cat([e[0] for e in entries], dim=0)
+        options = entries[0][1].copy()
+        pooled = [e[1].get('pooled_output', None) for e in entries]
+        if all(p is not None for p in pooled):
+            options['pooled_output'] = torch.cat(pooled, dim=0)
+        result.append([cond, options])
+    return result
+
+
+def conditions_batch_key(conditioning):
+    if conditioning is None:
+        return None
+    return tuple(tuple(c[0].shape) for c in conditioning)
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def encode_clip_vision(clip_vision, image):
@@ -229,31 +308,46 @@ class VAEApprox(torch.nn.Module):
 
 
 VAE_approx_model = None
+VAE_approx_lock = threading.Lock()  # the startup thread may be loading it while the first job samples
 taesd = None
 
 
 @torch.no_grad()
 @torch.inference_mode()
-def get_previewer(device, latent_format, is_sdxl=True):
-    global VAE_approx_model, taesd
+def load_vae_approx():
+    global VAE_approx_model
+
+    with VAE_approx_lock:
+        if VAE_approx_model is not None:
+            return
 
-    if VAE_approx_model is None and is_sdxl:
         from modules.path import vae_approx_path
         vae_approx_filename = os.path.join(vae_approx_path, 'xlvaeapp.pth')
         sd = torch.load(vae_approx_filename, map_location='cpu')
-        VAE_approx_model = VAEApprox()
-        VAE_approx_model.load_state_dict(sd)
+        model = VAEApprox()
+        model.load_state_dict(sd)
         del sd
-        VAE_approx_model.eval()
+        model.eval()
 
         if comfy.model_management.should_use_fp16():
-            VAE_approx_model.half()
-            VAE_approx_model.current_type = torch.float16
+            model.half()
+            model.current_type = torch.float16
         else:
-            VAE_approx_model.float()
-            VAE_approx_model.current_type = torch.float32
+            model.float()
+            model.current_type = torch.float32
+
+        model.to(comfy.model_management.get_torch_device())
+        VAE_approx_model = model
+    return
+
 
-        VAE_approx_model.to(comfy.model_management.get_torch_device())
+@torch.no_grad()
+@torch.inference_mode()
+def get_previewer(device, latent_format, is_sdxl=True):
+    global taesd
+
+    if is_sdxl:
+        load_vae_approx()
 
     @torch.no_grad()
     @torch.inference_mode()
@@ -261,9 +355,9 @@ def get_previewer(device, latent_format, is_sdxl=True):
         with torch.no_grad():
             x_sample = x0.to(VAE_approx_model.current_type)
             x_sample = VAE_approx_model(x_sample) * 127.5 + 127.5
-            x_sample = einops.rearrange(x_sample, 'b c h w -> b h w c')[0]
+            x_sample = einops.rearrange(x_sample, 'b c h w -> b h w c')
             x_sample = x_sample.cpu().numpy().clip(0, 255).astype(np.uint8)
-            return x_sample
+            return batch_preview(x_sample)
 
     if taesd is None and not is_sdxl:
         from latent_preview import TAESD, TAESDPreviewerImpl
@@ -283,10 +377,35 @@ def get_previewer(device, latent_format, is_sdxl=True):
             x_sample = taesd.decoder(torch.nn.functional.avg_pool2d(x0, kernel_size=(2, 2))).detach() * 255.0
             x_sample = einops.rearrange(x_sample, 'b c h w -> b h w c')
             x_sample = x_sample.cpu().numpy().clip(0, 255).astype(np.uint8)
-            return x_sample[0]
+            return batch_preview(x_sample)
 
     return preview_function if is_sdxl else preview_function_sd
 
+
+def batch_preview(x_sample):
+    # Single image for a single sample, one image per sample for batched sampling.
+    if x_sample.shape[0] == 1:
+        return x_sample[0]
+    return [x for x in x_sample]
+
+
+def normalize_seed(seed):
+    if isinstance(seed, (list, tuple)):
+        seed = [normalize_seed(s) for s in seed]
+        return seed[0] if len(seed) == 1 else seed
+    return seed if isinstance(seed, int) else random.randint(0, 2**63 - 1)
+
+
+def prepare_noise(latent, seed):
+    latent_image = latent["samples"]
+    if isinstance(seed, list):
+        # Per-sample seeds: each sample gets the same noise it would get when sampled alone.
+        assert len(seed) == latent_image.shape[0]
+        return torch.cat([comfy.sample.prepare_noise(latent_image[i:i + 1], s) for i, s in enumerate(seed)], dim=0)
+    batch_inds = latent["batch_index"] if "batch_index" in latent else None
+    return comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sampler_name='dpmpp_fooocus_2m_sde_inpaint_seamless',
@@ -297,7 +416,7 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
     #             "lms", "dpm_fast", "dpm_adaptive", "dpmpp_2s_ancestral", "dpmpp_sde", "dpmpp_sde_gpu",
     #             "dpmpp_2m", "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddpm", "ddim", "uni_pc", "uni_pc_bh2"]
 
-    seed = seed if isinstance(seed, int) else random.randint(0, 2**63 - 1)
+    seed = normalize_seed(seed)
 
     device = comfy.model_management.get_torch_device()
     latent_image = latent["samples"]
@@ -305,14 +424,13 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
-        batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+        noise = prepare_noise(latent, seed)
 
     noise_mask = None
     if "noise_mask" in latent:
         noise_mask = latent["noise_mask"]
 
-    previewer = get_previewer(device, model.model.latent_format, isinstance(model.model, SDXL))
+    previewer = get_previewer(device, model.model.latent_format, isinstance(model.model, (SDXL, SDXLRefiner)))
 
     pbar = comfy.utils.ProgressBar(steps)
 
@@ -370,7 +488,7 @@ def ksampler_with_refiner(model, positive, negative, refiner, refiner_positive,
     #             "lms", "dpm_fast", "dpm_adaptive", "dpmpp_2s_ancestral", "dpmpp_sde", "dpmpp_sde_gpu",
     #             "dpmpp_2m", "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddpm", "ddim", "uni_pc", "uni_pc_bh2"]
 
-    seed = seed if isinstance(seed, int) else random.randint(0, 2**63 - 1)
+    seed = normalize_seed(seed)
 
     device = comfy.model_management.get_torch_device()
     latent_image = latent["samples"]
@@ -378,8 +496,7 @@ def ksampler_with_refiner(model, positive, negative, refiner, refiner_positive,
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
-        batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+        noise = prepare_noise(latent, seed)
 
     noise_mask = None
     if "noise_mask" in latent:
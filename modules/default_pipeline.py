@@ -1,16 +1,25 @@
 import modules.core as core
 import os
 import gc
+import time
+import threading
+import collections
 import torch
 import numpy as np
 import modules.path
 import modules.virtual_memory as virtual_memory
+import modules.anisotropic as anisotropic
+import modules.patch
 import comfy.model_management
 
 from comfy.model_base import BaseModel, SDXL, SDXLRefiner
 from modules.settings import default_settings
-from modules.patch import set_comfy_adm_encoding, set_fooocus_adm_encoding, cfg_patched, patched_model_function
+from modules.patch import set_comfy_adm_encoding, set_fooocus_adm_encoding, cfg_patched, patched_model_function, encode_token_weights_batched
 from modules.expansion import FooocusExpansion
+from modules.cond_cache import ConditioningCache, clip_identity
+from modules.model_cache import ModelCache, PatchedModelCache
+from modules.readahead import PageCacheWarmer
+from modules.model_index import base_architectures, refiner_architectures
 
 
 xl_base: core.StableDiffusionModel = None
@@ -31,6 +40,44 @@ controlnet_canny_hash = ''
 controlnet_depth: core.StableDiffusionModel = None
 controlnet_depth_hash = ''
 
+# Text conditionings survive across jobs; keyed by text encoder identity (checkpoint, clip skip, LoRAs) and text.
+cond_cache = ConditioningCache(
+    max_bytes=int(default_settings['cond_cache_size_mb']) * 2**20,
+    disk_path=os.path.join(modules.path.cache_path, 'conditions') if default_settings['cond_cache_disk'] else None)
+
+# Checkpoints that were used before stay loaded (or in virtual memory) so switching back does not reload them from scratch.
+model_cache = ModelCache(
+    max_bytes=int(default_settings['model_cache_size_mb']) * 2**20,
+    max_models=int(default_settings['model_cache_max_models']))
+
+# LoRA-patched variants of the current base model, keyed by canonical LoRA stack and FreeU parameters.
+patched_cache = PatchedModelCache(
+    max_bytes=int(default_settings['lora_cache_size_mb']) * 2**20,
+    max_entries=int(default_settings['lora_cache_max_entries']))
+modules.patch.lora_products_max_bytes = int(default_settings['lora_delta_cache_mb']) * 2**20
+modules.patch.lora_merge_profile = default_settings['lora_merge_profile']
+core.lora_bake_mode = default_settings['lora_bake_cache']
+core.lora_bake_path = os.path.join(modules.path.cache_path, 'loras')
+core.lora_file_cache_max_bytes = int(default_settings['lora_file_cache_mb']) * 2**20
+core.model_snapshot_mode = default_settings['model_snapshots']
+core.model_snapshot_path = os.path.join(modules.path.cache_path, 'snapshots')
+virtual_memory.load_threads = max(1, int(default_settings['vm_load_threads']))
+virtual_memory.pin_memory = default_settings['vm_pin_memory']
+virtual_memory.mmap_mode = default_settings['vm_mmap']
+virtual_memory.index_fallback_path = os.path.join(modules.path.cache_path, 'vm_index')
+if default_settings['vm_policy'] in virtual_memory.policy_modes:
+    virtual_memory.policy_mode = default_settings['vm_policy']
+virtual_memory.policy_margin_bytes = int(default_settings['vm_policy_margin_mb']) * 2**20
+
+# Warms the page cache for the model files the next job will probably read, see predict_next_files.
+readahead = PageCacheWarmer(
+    mode=default_settings['readahead_mode'],
+    max_bytes_per_second=int(default_settings['readahead_mb_per_s']) * 2**20)
+recent_files = collections.deque(maxlen=32)
+
+# 'bilateral' or 'guided'; the guided filter is much cheaper on large latents.
+anisotropic.filter_type = default_settings['sharpness_filter']
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -48,10 +95,19 @@ def refresh_base_model(name):
 
     if xl_base_patched is not None:
         xl_base_patched = None
+    patched_cache.clear()
 
-    xl_base = core.load_model(filename)
-    if not isinstance(xl_base.unet.model, BaseModel):
+    # Files whose header says they are not a base model are rejected before anything is loaded.
+    description = modules.path.model_index.get(filename)
+    if description['type'] == 'lora' or \
+            (description['type'] == 'checkpoint' and description['architecture'] not in base_architectures + ['unknown']):
+        xl_base = None
+    else:
+        xl_base = model_cache.load('base', filename, core.load_model)
+        model_cache.restore(xl_base)
+    if xl_base is None or not isinstance(xl_base.unet.model, BaseModel):
         print(f'Model not supported: {name}, using default base model instead.')
+        model_cache.discard('base', filename)
         xl_base = None
         xl_base_hash = ''
         refresh_base_model(modules.path.default_base_model_name)
@@ -95,9 +151,16 @@ def refresh_refiner_model(name):
     if xl_refiner is not None:
         xl_refiner = None
 
-    xl_refiner = core.load_model(filename)
-    if not isinstance(xl_refiner.unet.model, SDXLRefiner):
+    # The refiner is read back from virtual memory when it is used.
+    description = modules.path.model_index.get(filename)
+    if description['type'] == 'lora' or \
+            (description['type'] == 'checkpoint' and description['architecture'] not in refiner_architectures + ['unknown']):
+        xl_refiner = None
+    else:
+        xl_refiner = model_cache.load('refiner', filename, core.load_model)
+    if xl_refiner is None or not isinstance(xl_refiner.unet.model, SDXLRefiner):
         print('Model not supported. Fooocus only support SDXL refiner as the refiner.')
+        model_cache.discard('refiner', filename)
         xl_refiner = None
         xl_refiner_hash = ''
         print(f'Refiner unloaded.')
@@ -117,9 +180,10 @@ def patch_base(loras, freeu, b1, b2, s1, s2):
     if xl_base_patched_hash == str(loras + [freeu, b1, b2, s1, s2]):
         return
 
-    model = xl_base
+    # LoRA patches are summed, so the order of the stack and disabled entries do not change the model.
+    stack = []
     for name, weight in loras:
-        if name == 'None':
+        if name == 'None' or weight == 0:
             continue
 
         if os.path.exists(name):
@@ -129,13 +193,28 @@ def patch_base(loras, freeu, b1, b2, s1, s2):
 
         assert os.path.exists(filename), 'Lora file not found!'
 
-        model = core.load_sd_lora(model, filename, strength_model=weight, strength_clip=weight)
-    if freeu:
-        xl_base_patched = core.freeu(model, b1, b2, s1, s2)
+        stack.append((os.path.abspath(os.path.realpath(filename)), os.path.getmtime(filename), weight))
+    stack = tuple(sorted(stack))
+    key = (xl_base_hash, stack, (b1, b2, s1, s2) if freeu else None)
+
+    patched = patched_cache.get(key)
+    if patched is None:
+        model = xl_base
+        for filename, _, weight in stack:
+            model = core.load_sd_lora(model, filename, strength_model=weight, strength_clip=weight)
+        if freeu:
+            patched = core.freeu(model, b1, b2, s1, s2)
+        else:
+            patched = model
+        if len(stack) > 0:
+            patched_cache.put(key, patched)
+        print(f'LoRAs loaded: {loras}')
     else:
-        xl_base_patched = model
+        print(f'LoRAs reused: {loras}')
+
+    xl_base_patched = patched
     xl_base_patched_hash = str(loras + [freeu, b1, b2, s1, s2])
-    print(f'LoRAs loaded: {loras}')
+    print(f'[LoRA Cache] {patched_cache}')
     if freeu:
         print(f'FreeU applied: {[b1, b2, s1, s2]}')
 
@@ -233,14 +312,15 @@ def apply_revision(base_cond, revision=False, revision_strengths=[], clip_vision
 @torch.no_grad()
 @torch.inference_mode()
 def clip_encode_single(clip, text, verbose=False):
-    cached = clip.fcs_cond_cache.get(text, None)
+    key = (clip_identity(clip), text)
+    cached = cond_cache.get(key)
     if cached is not None:
         if verbose:
             print(f'[CLIP Cached] {text}')
         return cached
     tokens = clip.tokenize(text)
     result = clip.encode_from_tokens(tokens, return_pooled=True)
-    clip.fcs_cond_cache[text] = result
+    cond_cache.put(key, result)
     if verbose:
         print(f'[CLIP Encoded] {text}')
     return result
@@ -273,20 +353,80 @@ def clip_encode(sd, texts, pool_top_k=1):
 
 @torch.no_grad()
 @torch.inference_mode()
-def clear_sd_cond_cache(sd):
-    if sd is None:
-        return None
-    if sd.clip is None:
-        return None
-    sd.clip.fcs_cond_cache = {}
-    return
+def clip_encode_batch(clip, texts, max_chunks=32):
+    if clip.layer_idx is not None:
+        clip.cond_stage_model.clip_layer(clip.layer_idx)
+    else:
+        clip.cond_stage_model.reset_clip_layer()
+    clip.load_model()
+
+    # hidden states of every layer are kept during the forward pass, so the number of 77-token chunks per batch is capped
+    results = []
+    group = []
+    group_chunks = 0
+    for text in texts:
+        tokens = clip.tokenize(text)
+        chunks = len(next(iter(tokens.values()))) if isinstance(tokens, dict) else len(tokens)
+        if len(group) > 0 and group_chunks + chunks > max_chunks:
+            results += encode_token_weights_batched(clip.cond_stage_model, group)
+            group = []
+            group_chunks = 0
+        group.append(tokens)
+        group_chunks += chunks
+    if len(group) > 0:
+        results += encode_token_weights_batched(clip.cond_stage_model, group)
+    return results
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode_many(sd, workloads, verbose=False):
+    # workloads: list of (texts, pool_top_k), result: list of conditions as returned by clip_encode.
+    # Every text that is not cached yet is encoded in a single batch for this model.
+    if sd is None or sd.clip is None:
+        return [None for _ in workloads]
+
+    clip = sd.clip
+    identity = clip_identity(clip)
+    encoded = {}
+    missing = []
+    for texts, _ in workloads:
+        for text in texts:
+            if text in encoded or text in missing:
+                continue
+            cached = cond_cache.get((identity, text))
+            if cached is None:
+                missing.append(text)
+            else:
+                encoded[text] = cached
+
+    if len(missing) > 0:
+        for text, result in zip(missing, clip_encode_batch(clip, missing)):
+            cond_cache.put((identity, text), result)
+            encoded[text] = result
+            if verbose:
+                print(f'[CLIP Encoded] {text}')
+
+    results = []
+    for texts, pool_top_k in workloads:
+        if not isinstance(texts, list) or len(texts) == 0:
+            results.append(None)
+            continue
+        cond_list = []
+        pooled_acc = 0
+        for i, text in enumerate(texts):
+            cond, pooled = encoded[text]
+            cond_list.append(cond)
+            if i < pool_top_k:
+                pooled_acc += pooled
+        results.append([[torch.cat(cond_list, dim=1), {"pooled_output": pooled_acc}]])
+    return results
 
 
 @torch.no_grad()
 @torch.inference_mode()
 def clear_all_caches():
-    clear_sd_cond_cache(xl_base_patched)
-    clear_sd_cond_cache(xl_refiner)
+    # The conditioning cache is bounded by its own budget and deliberately kept across jobs.
     gc.collect()
     comfy.model_management.soft_empty_cache()
 
@@ -301,28 +441,108 @@ def refresh_everything(refiner_model_name, base_model_name, loras, freeu, b1, b2
 
     refresh_base_model(base_model_name)
     virtual_memory.load_from_virtual_memory(xl_base.unet.model)
+    model_cache.trim(keep=[xl_base, xl_refiner])
+    print(f'[Model Cache] {model_cache}')
 
     patch_base(loras, freeu, b1, b2, s1, s2)
     clear_all_caches()
+
+    recent_files.extend(current_files())
+    readahead.warm(predict_next_files())
+    return
+
+
+def current_files():
+    files = [xl_base.unet.model.model_file['filename']]
+    if xl_refiner is not None:
+        files.append(xl_refiner.unet.model.model_file['filename'])
+    files += [os.path.abspath(lora[0]) for lora in getattr(xl_base_patched.clip, 'fcs_lora_identity', ())]
+    return files
+
+
+def predict_next_files(max_files=4):
+    # Checkpoints of models in virtual memory are read again by the next job; after them, the files used most
+    # by recent jobs that are not loaded right now.
+    files = []
+    for sd in [xl_refiner, xl_base]:
+        if sd is None:
+            continue
+        for m in [sd.unet.model, sd.clip.cond_stage_model]:
+            if isinstance(getattr(m, 'virtual_memory_dict', None), dict) and m.model_file['filename'] not in files:
+                files.append(m.model_file['filename'])
+
+    loaded = set(current_files()) | set(key[0] for key in core.lora_file_cache.keys())
+    for filename, _ in collections.Counter(recent_files).most_common():
+        if filename not in files and filename not in loaded:
+            files.append(filename)
+    return files[:max_files]
+
+
+expansion: FooocusExpansion = None
+
+
+def refresh_expansion():
+    global expansion
+    if expansion is None:
+        expansion = FooocusExpansion(clip_token_budget=default_settings['expansion_clip_budget'],
+                                      max_phrases=int(default_settings['expansion_max_phrases']))
     return
 
 
-refresh_everything(
-    refiner_model_name=default_settings['refiner_model'],
-    base_model_name=default_settings['base_model'],
-    loras=[(default_settings['lora_1_model'], default_settings['lora_1_weight']),
-        (default_settings['lora_2_model'], default_settings['lora_2_weight']),
-        (default_settings['lora_3_model'], default_settings['lora_3_weight']),
-        (default_settings['lora_4_model'], default_settings['lora_4_weight']),
-        (default_settings['lora_5_model'], default_settings['lora_5_weight'])],
-    freeu=default_settings['freeu'],
-    b1=default_settings['freeu_b1'],
-    b2=default_settings['freeu_b2'],
-    s1=default_settings['freeu_s1'],
-    s2=default_settings['freeu_s2']
-)
+# The default models, the prompt expansion and VAEApprox are loaded by startup() on a background thread, so the
+# UI does not wait for them. Each component sets its event when it is ready (or failed, the handler then loads it again).
+startup_events = dict(models=threading.Event(), expansion=threading.Event(), previewer=threading.Event())
+startup_status = 'Waiting'
 
-expansion = FooocusExpansion()
+
+def wait_for_startup(component, callback=None):
+    event = startup_events[component]
+    reported = None
+    while not event.wait(timeout=0.25):
+        if callback is not None and reported != startup_status:
+            reported = startup_status
+            callback(reported)
+    return
+
+
+def startup():
+    global startup_status
+    timer = time.perf_counter()
+    steps = [
+        ('models', 'base and refiner models', lambda: refresh_everything(
+            refiner_model_name=default_settings['refiner_model'],
+            base_model_name=default_settings['base_model'],
+            loras=[(default_settings['lora_1_model'], default_settings['lora_1_weight']),
+                (default_settings['lora_2_model'], default_settings['lora_2_weight']),
+                (default_settings['lora_3_model'], default_settings['lora_3_weight']),
+                (default_settings['lora_4_model'], default_settings['lora_4_weight']),
+                (default_settings['lora_5_model'], default_settings['lora_5_weight'])],
+            freeu=default_settings['freeu'],
+            b1=default_settings['freeu_b1'],
+            b2=default_settings['freeu_b2'],
+            s1=default_settings['freeu_s1'],
+            s2=default_settings['freeu_s2'])),
+        ('expansion', 'prompt expansion', refresh_expansion),
+        ('previewer', 'VAEApprox', core.load_vae_approx)
+    ]
+    for i, (component, title, load) in enumerate(steps):
+        startup_status = f'{i + 1}/{len(steps)} {title}'
+        print(f'[Startup] Loading {title} ...')
+        try:
+            load()
+        except Exception as e:
+            print(f'[Startup] Failed to load {title}: {e}')
+        finally:
+            startup_events[component].set()
+    startup_status = 'Done'
+    print(f'[Startup] Done in {time.perf_counter() - timer:.2f} seconds')
+    return
+
+
+if default_settings['background_startup']:
+    threading.Thread(target=startup, daemon=True).start()
+else:
+    startup()
 
 
 @torch.no_grad()
@@ -348,19 +568,29 @@ def patch_all_models():
 @torch.inference_mode()
 def process_diffusion(positive_cond, negative_cond, steps, switch, width, height, image_seed, sampler_name, scheduler, cfg, img2img, input_image, start_step,
         control_lora_canny, canny_edge_low, canny_edge_high, canny_start, canny_stop, canny_strength,
-        control_lora_depth, depth_start, depth_stop, depth_strength, callback, latent=None, denoise=1.0, tiled=False):
+        control_lora_depth, depth_start, depth_stop, depth_strength, callback, latent=None, denoise=1.0, tiled=False, phase='full'):
 
+    # phase='base' samples the base steps only and returns the intermediate latent,
+    # phase='refiner' finishes such a latent with the refiner and returns the images,
+    # so that a job can swap the refiner in once for all its tasks instead of once per image.
     patch_all_models()
 
+    if phase == 'refiner':
+        return process_refiner_phase(positive_cond, negative_cond, steps, switch, image_seed, sampler_name, scheduler, cfg,
+                                     start_step, callback, latent, denoise, tiled)
+
     if xl_refiner is not None:
         virtual_memory.try_move_to_virtual_memory(xl_refiner.unet.model)
     virtual_memory.load_from_virtual_memory(xl_base.unet.model)
 
+    # a list of seeds samples one batch with per-sample seeds and (already concatenated) conditions
+    batch_size = len(image_seed) if isinstance(image_seed, list) else 1
+
     if img2img and input_image != None:
         initial_latent = core.encode_vae(vae=xl_base_patched.vae, pixels=input_image)
         force_full_denoise = False
     elif latent is None:
-        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=1)
+        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=batch_size)
         force_full_denoise = True
     else:
         initial_latent = latent
@@ -378,6 +608,22 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
         positive_conditions, negative_conditions = core.apply_controlnet(positive_conditions, negative_conditions,
             controlnet_depth, input_image, depth_strength, depth_start, depth_stop)
 
+    if phase == 'base':
+        return core.ksampler(
+            model=xl_base_patched.unet,
+            positive=positive_conditions,
+            negative=negative_conditions,
+            latent=initial_latent,
+            steps=steps, start_step=start_step, last_step=min(start_step + switch, steps),
+            # the refiner phase resumes from the switch sigma, so the leftover noise must stay in the latent
+            disable_noise=False, force_full_denoise=False, denoise=denoise,
+            seed=image_seed,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            cfg=cfg,
+            callback_function=callback
+        )
+
     if xl_refiner is not None and is_base_sdxl():
         positive_conditions_refiner = positive_cond[1]
         negative_conditions_refiner = negative_cond[1]
@@ -418,3 +664,34 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
     images = core.pytorch_to_numpy(decoded_latent)
 
     return images
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def process_refiner_phase(positive_cond, negative_cond, steps, switch, image_seed, sampler_name, scheduler, cfg,
+                          start_step, callback, latent, denoise=1.0, tiled=False):
+    assert xl_refiner is not None
+
+    refiner_start_step = min(start_step + switch, steps)
+    if refiner_start_step < steps:
+        virtual_memory.try_move_to_virtual_memory(xl_base.unet.model)
+        virtual_memory.load_from_virtual_memory(xl_refiner.unet.model)
+
+        latent = core.ksampler(
+            model=xl_refiner.unet,
+            positive=positive_cond[1],
+            negative=negative_cond[1],
+            latent=latent,
+            steps=steps, start_step=refiner_start_step, last_step=steps,
+            disable_noise=True, force_full_denoise=True, denoise=denoise,
+            seed=image_seed,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            cfg=cfg,
+            callback_function=callback
+        )
+
+    decoded_latent = core.decode_vae(vae=xl_base_patched.vae, latent_image=latent, tiled=tiled)
+    images = core.pytorch_to_numpy(decoded_latent)
+
+    return images
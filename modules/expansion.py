@@ -1,10 +1,14 @@
+import os
 import torch
 
 import comfy.model_management as model_management
+import comfy.sd1_clip
 import modules.constants as constants
 
-from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
+from collections import OrderedDict
+from transformers import AutoTokenizer, AutoModelForCausalLM, CLIPTokenizer, LogitsProcessor, LogitsProcessorList, set_seed
 from modules.path import fooocus_expansion_path
+from modules.util import join_prompts
 from comfy.model_patcher import ModelPatcher
 
 
@@ -14,6 +18,9 @@ fooocus_magic_split = [
 ]
 dangrous_patterns = '[]【】()（）|:：'
 
+# CLIP encodes prompts in chunks of 77 tokens, 75 of them usable (start and end tokens excluded).
+clip_chunk_tokens = 75
+
 
 def safe_str(x):
     x = str(x)
@@ -28,9 +35,127 @@ def remove_pattern(x, pattern):
     return x
 
 
+class SeededSamplingProcessor(LogitsProcessor):
+    # Temperature, top-k and top-p sampling with one generator per row, so a row samples the same way whatever
+    # else is in the batch. Used with greedy decoding: the sampled token is the only finite score left.
+    def __init__(self, seeds, top_k=50, top_p=1.0, temperature=1.0):
+        self.generators = []
+        for seed in seeds:
+            generator = torch.Generator(device='cpu')
+            generator.manual_seed(seed)
+            self.generators.append(generator)
+        self.top_k = top_k if top_k is not None else 0
+        self.top_p = top_p if top_p is not None else 1.0
+        self.temperature = temperature if temperature else 1.0
+
+    def __call__(self, input_ids, scores):
+        scores = scores.float() / self.temperature
+        if self.top_k > 0:
+            kth = torch.topk(scores, min(self.top_k, scores.shape[-1]), dim=-1).values[..., -1, None]
+            scores = scores.masked_fill(scores < kth, -float('inf'))
+        if self.top_p < 1.0:
+            sorted_scores, sorted_indices = torch.sort(scores, descending=True, dim=-1)
+            cumulative = torch.softmax(sorted_scores, dim=-1).cumsum(dim=-1)
+            # Keep the smallest set of tokens whose probability reaches top_p, always including the best one.
+            remove = cumulative - torch.softmax(sorted_scores, dim=-1) >= self.top_p
+            scores = scores.masked_fill(remove.scatter(1, sorted_indices, remove), -float('inf'))
+        probs = torch.softmax(scores, dim=-1).cpu()
+        tokens = torch.stack([torch.multinomial(probs[i], 1, generator=g) for i, g in enumerate(self.generators)])
+        result = torch.full_like(scores, -float('inf'))
+        result.scatter_(1, tokens.to(scores.device), 0.0)
+        return result
+
+
+def count_phrases(text, phrases=0, in_phrase=False):
+    # Non-empty comma separated phrases, continued from the state of the text before this one.
+    for c in text:
+        if c == ',':
+            in_phrase = False
+        elif not c.isspace() and not in_phrase:
+            phrases += 1
+            in_phrase = True
+    return phrases, in_phrase
+
+
+class ExpansionBudgetProcessor(LogitsProcessor):
+    # Ends a row (forces EOS) once prompt + expansion fill the CLIP chunk the prompt ends in,
+    # or once the expansion has more phrases than max_phrases.
+    # CLIP splits text at whitespace before its BPE, so token counts add up word by word: the words before the
+    # last one are counted once, when a generated token starts a new word, and only the last word is counted
+    # again at every step.
+    def __init__(self, expansion, origins, seeds):
+        self.expansion = expansion
+        self.targets = [expansion.clip_token_target(origin) for origin in origins]
+        self.done = [False for _ in origins]
+        self.counted_tokens = [expansion.count_clip_tokens(origin) if self.targets[i] is not None else 0
+                               for i, origin in enumerate(origins)]
+        self.counted_phrases = [(0, False) for _ in origins]
+        # The magic split is part of the expansion text; without a prompt, join_prompts drops its leading comma.
+        self.tail_texts = []
+        for origin, seed in zip(origins, seeds):
+            split = fooocus_magic_split[seed % len(fooocus_magic_split)]
+            self.tail_texts.append(split if origin != '' else split.lstrip(', '))
+        self.tail_ids = [[] for _ in origins]
+        self.prompt_length = None
+
+    def flush(self, i):
+        text = self.tail_texts[i] + self.expansion.tokenizer.decode(self.tail_ids[i], skip_special_tokens=True)
+        if self.targets[i] is not None:
+            self.counted_tokens[i] += self.expansion.count_clip_tokens(text)
+        self.counted_phrases[i] = count_phrases(text, *self.counted_phrases[i])
+        self.tail_texts[i] = ''
+        self.tail_ids[i] = []
+
+    def exceeds_budget(self, i):
+        text = self.tail_texts[i] + self.expansion.tokenizer.decode(self.tail_ids[i], skip_special_tokens=True)
+        # safe_str strips the trailing separators of the final expansion.
+        text = text.rstrip(",. \r\n")
+        phrases, _ = count_phrases(text, *self.counted_phrases[i])
+        if self.expansion.max_phrases > 0 and phrases > self.expansion.max_phrases:
+            return True
+        if self.targets[i] is not None and self.counted_tokens[i] + self.expansion.count_clip_tokens(text) >= self.targets[i]:
+            return True
+        return False
+
+    def __call__(self, input_ids, scores):
+        eos_token_id = self.expansion.tokenizer.eos_token_id
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+        for i in range(input_ids.shape[0]):
+            if not self.done[i] and input_ids.shape[1] > self.prompt_length:
+                token_id = int(input_ids[i, -1])
+                if self.expansion.tokenizer.convert_ids_to_tokens(token_id).startswith('Ġ'):
+                    self.flush(i)
+                self.tail_ids[i].append(token_id)
+            if not self.done[i]:
+                self.done[i] = self.exceeds_budget(i)
+            if self.done[i]:
+                scores[i, :] = -float('inf')
+                scores[i, eos_token_id] = 0.0
+        return scores
+
+
 class FooocusExpansion:
-    def __init__(self):
+    def __init__(self, max_cache_entries=1024, max_batch_size=16, clip_token_budget=True, max_phrases=0):
+        self.clip_token_budget = clip_token_budget
+        self.max_phrases = max_phrases
+        self.clip_tokenizer = None
+        if self.clip_token_budget:
+            try:
+                clip_tokenizer_path = os.path.join(os.path.dirname(os.path.realpath(comfy.sd1_clip.__file__)), 'sd1_tokenizer')
+                self.clip_tokenizer = CLIPTokenizer.from_pretrained(clip_tokenizer_path)
+            except Exception as e:
+                print(f'[Prompt Expansion] CLIP tokenizer not available, token budget disabled: {e}')
+
+        self.cache = OrderedDict()
+        self.max_cache_entries = max_cache_entries
+        self.max_batch_size = max_batch_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         self.tokenizer = AutoTokenizer.from_pretrained(fooocus_expansion_path)
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = 'left'
         self.model = AutoModelForCausalLM.from_pretrained(fooocus_expansion_path)
         self.model.eval()
 
@@ -63,10 +188,111 @@ class FooocusExpansion:
         features = self.model.generate(**tokenized_kwargs,
                                        num_beams=1,
                                        max_new_tokens=256,
-                                       do_sample=True)
+                                       do_sample=True,
+                                       logits_processor=self.budget_processors([origin], [seed]))
 
         response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
         result = response[0][len(origin):]
         result = safe_str(result)
         result = remove_pattern(result, dangrous_patterns)
+        result = self.fit_budget(origin, result)
         return result
+
+    def count_clip_tokens(self, text):
+        return len(self.clip_tokenizer(text)['input_ids']) - 2
+
+    def clip_token_target(self, origin):
+        if self.clip_tokenizer is None:
+            return None
+        return (self.count_clip_tokens(origin) // clip_chunk_tokens + 1) * clip_chunk_tokens
+
+    def fit_budget(self, origin, expansion):
+        # Generation stops after the budget is reached, so drop the phrases that spill over.
+        if not self.has_budget():
+            return expansion
+        phrases = [p.strip() for p in expansion.split(',') if p.strip() != '']
+        target = self.clip_token_target(origin)
+        if (self.max_phrases <= 0 or len(phrases) <= self.max_phrases) and \
+                (target is None or self.count_clip_tokens(join_prompts(origin, expansion)) <= target):
+            # Within budget, the text is kept as generated.
+            return expansion
+        if self.max_phrases > 0:
+            phrases = phrases[:self.max_phrases]
+        if target is not None:
+            while len(phrases) > 0 and self.count_clip_tokens(join_prompts(origin, ', '.join(phrases))) > target:
+                phrases.pop()
+        return ', '.join(phrases)
+
+    def has_budget(self):
+        return self.clip_tokenizer is not None or self.max_phrases > 0
+
+    def budget_processors(self, origins, seeds):
+        if not self.has_budget():
+            return LogitsProcessorList()
+        return LogitsProcessorList([ExpansionBudgetProcessor(self, origins, seeds)])
+
+    def expand_many(self, prompts, seeds):
+        # Results are cached by (prompt, seed); uncached prompts are generated together with left padding.
+        keys = [(safe_str(prompt), int(seed) % constants.SEED_LIMIT_NUMPY) for prompt, seed in zip(prompts, seeds)]
+        results = {}
+        missing = []
+        for key in keys:
+            if key in results or key in missing:
+                continue
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                results[key] = self.cache[key]
+                self.cache_hits += 1
+            else:
+                missing.append(key)
+                self.cache_misses += 1
+
+        # A single prompt keeps the set_seed sampling of __call__, so existing (prompt, seed) pairs expand as before.
+        # Rows of a larger batch cannot share the global generator, they are sampled with one generator each.
+        if len(missing) == 1:
+            prompt, seed = missing[0]
+            results[missing[0]] = self(prompt, seed)
+        elif len(missing) > 1:
+            for i in range(0, len(missing), self.max_batch_size):
+                batch = missing[i:i + self.max_batch_size]
+                for key, result in zip(batch, self.generate_batch(batch)):
+                    results[key] = result
+
+        for key in missing:
+            self.cache[key] = results[key]
+            if len(self.cache) > self.max_cache_entries:
+                self.cache.popitem(last=False)
+
+        print(f'[Prompt Expansion] Cache hits = {self.cache_hits}, misses = {self.cache_misses}')
+        return [results[key] for key in keys]
+
+    def generate_batch(self, keys):
+        model_management.load_model_gpu(self.patcher)
+        origins = [prompt for prompt, _ in keys]
+        seeds = [seed for _, seed in keys]
+        prompts = [origin + fooocus_magic_split[seed % len(fooocus_magic_split)] for origin, seed in zip(origins, seeds)]
+
+        tokenized_kwargs = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        tokenized_kwargs.data['input_ids'] = tokenized_kwargs.data['input_ids'].to(self.patcher.load_device)
+        tokenized_kwargs.data['attention_mask'] = tokenized_kwargs.data['attention_mask'].to(self.patcher.load_device)
+
+        generation_config = self.model.generation_config
+        logits_processor = LogitsProcessorList([SeededSamplingProcessor(seeds, top_k=generation_config.top_k,
+                                                                        top_p=generation_config.top_p,
+                                                                        temperature=generation_config.temperature)])
+        logits_processor += self.budget_processors(origins, seeds)
+        features = self.model.generate(**tokenized_kwargs,
+                                       num_beams=1,
+                                       max_new_tokens=256,
+                                       do_sample=False,
+                                       pad_token_id=self.tokenizer.pad_token_id,
+                                       logits_processor=logits_processor)
+
+        response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
+        results = []
+        for origin, text in zip(origins, response):
+            result = safe_str(text[len(origin):])
+            result = remove_pattern(result, dangrous_patterns)
+            result = self.fit_budget(origin, result)
+            results.append(result)
+        return results
@@ -0,0 +1,74 @@
+import os
+import time
+import threading
+
+
+class FileInventory:
+    # Directory listings keyed by absolute path, with the (mtime, size) of every file.
+    # Adding, removing or renaming a file changes the mtime of its directory, so a rescan only lists the
+    # directories whose mtime changed and otherwise costs one stat per directory. A file rewritten in place
+    # keeps the directory mtime, so a listing is also made again once it is older than full_rescan_interval
+    # seconds; clear() lists everything again right away.
+    def __init__(self, full_rescan_interval=600):
+        self.directories = {}
+        self.lock = threading.Lock()
+        self.full_rescan_interval = full_rescan_interval
+        self.listed = 0
+        self.reused = 0
+
+    def list_directory(self, path):
+        mtime = os.stat(path).st_mtime
+        now = time.time()
+        with self.lock:
+            entry = self.directories.get(path, None)
+            if entry is not None and entry[0] == mtime and now - entry[3] < self.full_rescan_interval:
+                self.reused += 1
+                return entry
+
+        files = {}
+        subdirectories = []
+        with os.scandir(path) as entries:
+            for e in entries:
+                # Like os.walk: symlinked directories are not followed and are not files either.
+                if e.is_dir():
+                    if not e.is_symlink():
+                        subdirectories.append(e.name)
+                    continue
+                try:
+                    stat = e.stat()
+                    files[e.name] = (stat.st_mtime, stat.st_size)
+                except OSError:
+                    files[e.name] = (0.0, 0)
+
+        entry = (mtime, files, subdirectories, now)
+        with self.lock:
+            self.directories[path] = entry
+            self.listed += 1
+        return entry
+
+    def walk(self, folder_path, relative_path=''):
+        # Yields (relative_path, files) in the order of os.walk.
+        path = os.path.join(folder_path, relative_path) if relative_path else folder_path
+        try:
+            _, files, subdirectories, _ = self.list_directory(path)
+        except OSError:
+            return
+        yield relative_path, files
+        for name in subdirectories:
+            yield from self.walk(folder_path, os.path.join(relative_path, name))
+
+    def files(self, folder_path):
+        # Relative path -> (mtime, size) of every file under folder_path.
+        folder_path = os.path.abspath(folder_path)
+        result = {}
+        for relative_path, files in self.walk(folder_path):
+            for filename, stat in files.items():
+                result[os.path.join(relative_path, filename)] = stat
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.directories.clear()
+
+    def __str__(self):
+        return f'directories = {len(self.directories)}, listed = {self.listed}, reused = {self.reused}'
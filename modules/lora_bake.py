@@ -0,0 +1,99 @@
+import os
+import time
+import hashlib
+import torch
+import comfy.model_management
+import modules.virtual_memory as virtual_memory
+
+from safetensors.torch import save_file
+
+
+# Baked LoRAs store one dense delta per weight key at unit strength, so applying them is a plain add.
+# 'quantized' uses the (uint8, min, max) 3-tuple of .fooocus.patch files with one range per output row,
+# 'fp16' stores the delta itself as a 1-tuple patch.
+bake_modes = ['quantized', 'fp16']
+
+
+def baked_filename(cache_path, model, lora_filename, mode):
+    # Deltas only depend on the LoRA file and on the key layout of the model architecture.
+    identity = str((os.path.abspath(lora_filename), os.path.getmtime(lora_filename), mode,
+                    type(model.unet.model).__name__, type(model.clip.cond_stage_model).__name__))
+    name = os.path.splitext(os.path.basename(lora_filename))[0]
+    return os.path.join(cache_path, f'{name}.{hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]}.safetensors')
+
+
+def quantize(delta):
+    rows = delta.reshape(delta.shape[0], -1)
+    w_min = rows.min(dim=1, keepdim=True).values
+    w_max = rows.max(dim=1, keepdim=True).values
+    scale = torch.where(w_max > w_min, w_max - w_min, torch.ones_like(w_max))
+    w = ((rows - w_min) / scale * 255.0).round().clamp(0, 255).to(torch.uint8).reshape(delta.shape)
+    range_shape = [delta.shape[0]] + [1] * (len(delta.shape) - 1)
+    return w, w_min.reshape(range_shape), w_max.reshape(range_shape)
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def bake(model, loaded, mode):
+    # Keys that are not in the model are skipped, add_patches would ignore them anyway.
+    device = comfy.model_management.get_torch_device()
+    patchers = [model.unet, model.clip.patcher]
+    state_dicts = [patcher.model.state_dict() for patcher in patchers]
+    baked = {}
+    for key, v in loaded.items():
+        index = next((i for i, sd in enumerate(state_dicts) if key in sd), None)
+        if index is None:
+            continue
+        weight = torch.zeros(state_dicts[index][key].shape, dtype=torch.float32, device=device)
+        delta = patchers[index].calculate_weight([(1.0, v, 1.0)], weight, key).to('cpu')
+        if mode == 'quantized':
+            baked[key] = quantize(delta)
+        else:
+            baked[key] = (delta.to(torch.float16), )
+    return baked
+
+
+def save_baked(filename, baked, lora_filename):
+    tensors = {}
+    for key, patch in baked.items():
+        for i, t in enumerate(patch):
+            tensors[f'{key}::{i}'] = t.contiguous()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_filename = filename + '.tmp'
+    save_file(tensors, temp_filename, metadata={'lora': os.path.basename(lora_filename)})
+    os.replace(temp_filename, filename)
+
+
+def load_baked(filename):
+    # The deltas are views of the memory-mapped file, so only the pages that are added to a weight are read.
+    buffer, header, data_start, _ = virtual_memory.open_mmap(filename)
+    patches = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        t = virtual_memory.mmap_tensor(buffer, info, data_start)
+        key, i = name.rsplit('::', 1)
+        patches.setdefault(key, {})[int(i)] = t
+    return {key: tuple(parts[i] for i in range(len(parts))) for key, parts in patches.items()}
+
+
+def load_or_bake(cache_path, model, lora_filename, loaded_fn, mode):
+    filename = baked_filename(cache_path, model, lora_filename, mode)
+    if os.path.exists(filename):
+        try:
+            timer = time.perf_counter()
+            result = load_baked(filename)
+            print(f'[LoRA Bake] Loaded {filename} in {time.perf_counter() - timer:.2f} seconds')
+            return result
+        except Exception as e:
+            print(f'[LoRA Bake] Failed to read {filename}: {e}')
+
+    loaded = loaded_fn()
+    timer = time.perf_counter()
+    baked = bake(model, loaded, mode)
+    try:
+        save_baked(filename, baked, lora_filename)
+        print(f'[LoRA Bake] Baked {lora_filename} in {time.perf_counter() - timer:.2f} seconds: {filename}')
+    except Exception as e:
+        print(f'[LoRA Bake] Failed to write {filename}: {e}')
+    return baked
@@ -0,0 +1,188 @@
+import os
+import time
+import torch
+import modules.virtual_memory as virtual_memory
+
+from collections import OrderedDict
+
+
+def model_components(sd):
+    # The torch modules of a StableDiffusionModel that the Virtual Memory System knows how to release.
+    components = []
+    if sd.unet is not None:
+        components.append(sd.unet.model)
+    if sd.clip is not None:
+        components.append(sd.clip.cond_stage_model)
+    if sd.vae is not None:
+        components.append(sd.vae.first_stage_model)
+    return components
+
+
+def resident_bytes(sd):
+    result = 0
+    for component in model_components(sd):
+        for v in component.state_dict().values():
+            result += v.numel() * v.element_size()
+    return result
+
+
+def in_virtual_memory(component):
+    # An empty dict means that none of the weights could be found in the checkpoint, they are all still resident.
+    virtual_memory_dict = getattr(component, 'virtual_memory_dict', None)
+    return isinstance(virtual_memory_dict, dict) and len(virtual_memory_dict) > 0
+
+
+class ModelCache:
+    # Loaded checkpoints keyed by (role, filename). Models that are not in use are moved to the
+    # Virtual Memory System, least recently used first, until the idle resident ones fit in max_bytes.
+    # A model in virtual memory keeps its module structure and only reads its weights back from disk.
+    def __init__(self, max_bytes, max_models=4):
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.restore_time = 0.0
+
+    def load(self, role, filename, loader):
+        key = (role, filename)
+        mtime = os.path.getmtime(filename)
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[1] == mtime:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        if entry is not None:
+            del self.entries[key]
+
+        timer = time.perf_counter()
+        sd = loader(filename)
+        self.load_time += time.perf_counter() - timer
+        self.misses += 1
+        self.entries[key] = (sd, mtime)
+        print(f'[Model Cache] Loaded {filename} in {time.perf_counter() - timer:.2f} seconds')
+        return sd
+
+    def discard(self, role, filename):
+        self.entries.pop((role, filename), None)
+
+    @torch.no_grad()
+    def restore(self, sd):
+        timer = time.perf_counter()
+        restored = False
+        for component in model_components(sd):
+            if in_virtual_memory(component):
+                virtual_memory.load_from_virtual_memory(component)
+                restored = True
+        if restored:
+            self.restore_time += time.perf_counter() - timer
+        return
+
+    @torch.no_grad()
+    def trim(self, keep):
+        # keep: models currently referenced by the pipeline; they are never released here.
+        keep_ids = [id(sd) for sd in keep if sd is not None]
+        candidates = [key for key, (sd, _) in self.entries.items() if id(sd) not in keep_ids]
+
+        total = sum(resident_bytes(self.entries[key][0]) for key in candidates)
+        for key in candidates:
+            if total <= self.max_bytes:
+                break
+            sd = self.entries[key][0]
+            total -= resident_bytes(sd)
+            for component in model_components(sd):
+                if not in_virtual_memory(component):
+                    virtual_memory.move_to_virtual_memory(component)
+            if all(in_virtual_memory(component) for component in model_components(sd)):
+                total += resident_bytes(sd)
+            else:
+                # Not a safetensors file or keys that are not in it: the weights cannot be read back lazily.
+                del self.entries[key]
+            self.evictions += 1
+
+        while len(self.entries) > self.max_models:
+            key = next((k for k in candidates if k in self.entries), None)
+            if key is None:
+                break
+            del self.entries[key]
+        return
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.entries),
+                    load_time=self.load_time, restore_time=self.restore_time, max_bytes=self.max_bytes)
+
+    def __str__(self):
+        resident = sum(resident_bytes(sd) for sd, _ in self.entries.values())
+        return f'hits = {self.hits}, misses = {self.misses}, evictions = {self.evictions}, ' \
+               f'entries = {len(self.entries)}, resident = {resident / 2**20:.1f} MB, ' \
+               f'load time = {self.load_time:.2f}s, restore time = {self.restore_time:.2f}s'
+
+
+def tensor_bytes(value):
+    # Bytes of the distinct tensors in nested dicts, lists and tuples.
+    seen = set()
+    result = 0
+    stack = [value]
+    while len(stack) > 0:
+        value = stack.pop()
+        if isinstance(value, torch.Tensor):
+            if id(value) not in seen:
+                seen.add(id(value))
+                result += value.numel() * value.element_size()
+        elif isinstance(value, dict):
+            stack += list(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack += list(value)
+    return result
+
+
+def patch_bytes(sd):
+    # Bytes held by the LoRA patches of a patched model; the base weights are shared with the unpatched model.
+    patchers = [sd.unet]
+    if sd.clip is not None:
+        patchers.append(sd.clip.patcher)
+    return tensor_bytes([patcher.patches for patcher in patchers if patcher is not None])
+
+
+class PatchedModelCache:
+    # LoRA-patched ModelPatcher clones keyed by their canonical LoRA stack. The clones share the base
+    # weights, so an entry only costs its LoRA tensors; entries are evicted least recently used first.
+    def __init__(self, max_bytes, max_entries=8):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, sd):
+        size = patch_bytes(sd)
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (sd, size)
+        self.current_bytes += size
+        while len(self.entries) > 0 and (self.current_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            _, (_, old_size) = self.entries.popitem(last=False)
+            self.current_bytes -= old_size
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def __str__(self):
+        return f'hits = {self.hits}, misses = {self.misses}, entries = {len(self.entries)}, ' \
+               f'size = {self.current_bytes / 2**20:.1f}/{self.max_bytes / 2**20:.1f} MB'
@@ -0,0 +1,174 @@
+import os
+import re
+import json
+import struct
+import threading
+
+from collections import Counter
+
+
+# What a model file is, read from its safetensors header only (tensor names, shapes and dtypes):
+#   type: 'checkpoint', 'lora' or 'unknown',
+#   architecture: 'sdxl', 'sdxl_refiner', 'sd15', 'sd2' or 'unknown' (for a LoRA, the model it was trained on),
+#   rank and target ('unet', 'clip' or 'unet+clip') for LoRAs, size in bytes and the dtype holding most of the weights.
+# Other formats cannot be read without unpickling them, they are 'unknown' and never rejected.
+base_architectures = ['sdxl', 'sd15', 'sd2']
+refiner_architectures = ['sdxl_refiner']
+
+# The width of the cross attention keys is the text conditioning width: 768 for SD 1.x, 1024 for SD 2.x,
+# 2048 for the two SDXL text encoders and 1280 for the refiner, which only has the OpenCLIP G encoder.
+context_architectures = {768: 'sd15', 1024: 'sd2', 2048: 'sdxl', 1280: 'sdxl_refiner'}
+
+safetensors_dtype_names = {
+    'F64': 'float64', 'F32': 'float32', 'F16': 'float16', 'BF16': 'bfloat16',
+    'I64': 'int64', 'I32': 'int32', 'I16': 'int16', 'I8': 'int8', 'U8': 'uint8', 'BOOL': 'bool',
+}
+
+
+def read_safetensors_header(filename):
+    with open(filename, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        if header_size > 128 * 2**20:
+            raise ValueError(f'Header of {header_size} bytes')
+        header = json.loads(f.read(header_size))
+    header.pop('__metadata__', None)
+    return header
+
+
+def main_dtype(header):
+    sizes = Counter()
+    for info in header.values():
+        begin, end = info['data_offsets']
+        sizes[info['dtype']] += end - begin
+    if len(sizes) == 0:
+        return 'unknown'
+    dtype = sizes.most_common(1)[0][0]
+    return safetensors_dtype_names.get(dtype, dtype)
+
+
+def describe_checkpoint(header):
+    context_dim = None
+    for key, info in header.items():
+        if key.startswith('model.diffusion_model.') and key.endswith('attn2.to_k.weight'):
+            context_dim = info['shape'][1]
+            break
+    if context_dim is None:
+        return dict(type='unknown', architecture='unknown')
+    return dict(type='checkpoint', architecture=context_architectures.get(context_dim, 'unknown'))
+
+
+def describe_lora(header):
+    ranks = Counter()
+    context_dim = None
+    targets = set()
+    text_encoders = set()
+    for key, info in header.items():
+        if key.endswith('lora_down.weight') or key.endswith('lora_A.weight'):
+            ranks[info['shape'][0]] += 1
+        if key.startswith('lora_unet_') or '.unet.' in key or key.startswith('unet.'):
+            targets.add('unet')
+            if 'attn2_to_k' in key and key.endswith('lora_down.weight'):
+                context_dim = info['shape'][1]
+        match = re.match(r'lora_te(\d?)_', key)
+        if match is not None:
+            targets.add('clip')
+            text_encoders.add(match.group(1))
+
+    architecture = context_architectures.get(context_dim, 'unknown')
+    if architecture == 'unknown' and len(text_encoders) > 0:
+        architecture = 'sdxl' if '2' in text_encoders else 'sd15'
+
+    return dict(type='lora', architecture=architecture,
+                rank=ranks.most_common(1)[0][0] if len(ranks) > 0 else 0,
+                target='+'.join(t for t in ['unet', 'clip'] if t in targets))
+
+
+def describe(filename):
+    result = dict(type='unknown', architecture='unknown', size=os.path.getsize(filename), dtype='unknown')
+    if not filename.lower().endswith('.safetensors'):
+        return result
+    header = read_safetensors_header(filename)
+    result['dtype'] = main_dtype(header)
+    if any('lora_down' in key or 'lora_up' in key or '.lora_A.' in key for key in header.keys()):
+        result.update(describe_lora(header))
+    else:
+        result.update(describe_checkpoint(header))
+    return result
+
+
+class ModelIndex:
+    # Descriptions of model files keyed by absolute path, valid while (mtime, size) does not change.
+    # They are kept in a JSON file, so a restart only reads the headers of new or modified files.
+    def __init__(self, disk_filename=None):
+        self.disk_filename = disk_filename
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if disk_filename is not None and os.path.exists(disk_filename):
+            try:
+                with open(disk_filename, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f'[Model Index] Failed to read {disk_filename}: {e}')
+
+    def get(self, filename, stat=None):
+        # stat: (mtime, size) when the caller already knows them, e.g. from the file inventory.
+        filename = os.path.abspath(filename)
+        if stat is not None:
+            mtime, size = stat
+        else:
+            try:
+                mtime = os.path.getmtime(filename)
+                size = os.path.getsize(filename)
+            except OSError:
+                return dict(type='unknown', architecture='unknown', size=0, dtype='unknown')
+
+        with self.lock:
+            entry = self.entries.get(filename, None)
+            if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+                return entry
+
+        try:
+            entry = describe(filename)
+        except Exception as e:
+            print(f'[Model Index] Failed to read the header of {filename}: {e}')
+            entry = dict(type='unknown', architecture='unknown', size=size, dtype='unknown')
+        entry['mtime'] = mtime
+
+        with self.lock:
+            self.entries[filename] = entry
+            self.dirty = True
+        return entry
+
+    def scan(self, folder, names, stats=None):
+        stats = stats if stats is not None else {}
+        result = {name: self.get(os.path.join(folder, name), stats.get(name, None)) for name in names}
+        self.save()
+        return result
+
+    def filter(self, folder, names, types, architectures, stats=None):
+        # Files that cannot be described are kept, only the known mismatches are left out.
+        descriptions = self.scan(folder, names, stats)
+        return [name for name in names
+                if descriptions[name]['type'] in types + ['unknown']
+                and descriptions[name]['architecture'] in architectures + ['unknown']]
+
+    def save(self):
+        if self.disk_filename is None or not self.dirty:
+            return
+        with self.lock:
+            # Forget files that were deleted since they were indexed.
+            entries = {k: v for k, v in self.entries.items() if os.path.exists(k)}
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.disk_filename), exist_ok=True)
+            temp_filename = self.disk_filename + '.tmp'
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(temp_filename, self.disk_filename)
+        except OSError as e:
+            print(f'[Model Index] Failed to write {self.disk_filename}: {e}')
+
+    def __str__(self):
+        counts = Counter(f"{v['type']}/{v['architecture']}" for v in self.entries.values())
+        return ', '.join(f'{k} = {v}' for k, v in sorted(counts.items()))
@@ -0,0 +1,130 @@
+import os
+import time
+import shutil
+import hashlib
+import torch
+import comfy.utils
+import comfy.model_management
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+from modules.model_index import read_safetensors_header
+
+
+# A snapshot is a safetensors copy of a checkpoint that loads without unpickling or casting anything:
+# the state dict is unwrapped, EMA and training leftovers are dropped, every tensor is contiguous and the
+# UNet and text encoder weights are already in the dtype they are used in. The key names are kept, so
+# load_checkpoint_guess_config and the Virtual Memory System key translation work on it unchanged.
+#   'ckpt': only pickled checkpoints (.ckpt, .pt, .pth, .bin) are converted, they can then be offloaded,
+#   'all': safetensors checkpoints are converted too, when their dtype differs from the target.
+snapshot_modes = ['ckpt', 'all']
+pickle_extensions = ['.ckpt', '.pt', '.pth', '.bin']
+dropped_prefixes = ['model_ema.', 'optimizer.', 'lr_scheduler.']
+# The VAE keeps its own dtype, ComfyUI runs it in float32 unless told otherwise.
+kept_dtype_prefixes = ['first_stage_model.']
+
+
+def target_dtype():
+    return torch.float16 if comfy.model_management.should_use_fp16() else torch.float32
+
+
+def snapshot_filename(cache_path, ckpt_filename, dtype):
+    identity = str((os.path.abspath(ckpt_filename), os.path.getmtime(ckpt_filename), os.path.getsize(ckpt_filename), str(dtype)))
+    name = os.path.splitext(os.path.basename(ckpt_filename))[0]
+    return os.path.join(cache_path, f'{name}.{hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]}.safetensors')
+
+
+def needs_snapshot(ckpt_filename, mode, dtype):
+    if os.path.splitext(ckpt_filename)[1].lower() in pickle_extensions:
+        return True
+    if mode != 'all':
+        return False
+    # From the JSON header, safetensors 0.3.1 has no get_dtype on its slices.
+    for key, info in read_safetensors_header(ckpt_filename).items():
+        if key.startswith('model.diffusion_model.'):
+            return info['dtype'] != {torch.float16: 'F16', torch.float32: 'F32'}[dtype]
+    return False
+
+
+def normalize(sd, dtype):
+    result = {}
+    for key, value in sd.items():
+        if not isinstance(value, torch.Tensor) or any(key.startswith(p) for p in dropped_prefixes):
+            continue
+        if value.is_floating_point() and not any(key.startswith(p) for p in kept_dtype_prefixes):
+            value = value.to(dtype)
+        result[key] = value.contiguous()
+    return result
+
+
+def remove_stale_snapshots(cache_path, keep=None):
+    # Snapshots whose checkpoint was deleted, or modified since: the name of a snapshot is derived from the
+    # (path, mtime, size, dtype) of its source, so a snapshot not at the current name of its source is stale.
+    for filename in os.listdir(cache_path):
+        path = os.path.join(cache_path, filename)
+        if path == keep or not filename.endswith('.safetensors'):
+            continue
+        try:
+            with safe_open(path, framework="pt", device='cpu') as f:
+                metadata = f.metadata() or {}
+            source = metadata.get('source', None)
+            if source is None:
+                continue
+            if not os.path.exists(source) or snapshot_filename(cache_path, source, metadata.get('dtype', '')) != path:
+                os.remove(path)
+                print(f'[Model Snapshot] Removed stale snapshot {path}')
+        except Exception as e:
+            print(f'[Model Snapshot] Failed to check {path}: {e}')
+
+
+def snapshot_size(sd):
+    # Bytes of the tensor data at their target dtype, the header is small next to it.
+    return sum(value.numel() * value.element_size() for value in sd.values())
+
+
+def make_snapshot(ckpt_filename, filename, dtype):
+    # Returns False when there is not enough free space for the snapshot.
+    sd = normalize(comfy.utils.load_torch_file(ckpt_filename), dtype)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if shutil.disk_usage(os.path.dirname(filename)).free < snapshot_size(sd) * 1.05 + 64 * 2**20:
+        return False
+    temp_filename = filename + '.tmp'
+    try:
+        save_file(sd, temp_filename, metadata={'source': os.path.abspath(ckpt_filename), 'dtype': str(dtype)})
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+    return True
+
+
+# Cache folders already checked for stale snapshots by this process.
+checked_cache_paths = set()
+
+
+def get_snapshot(cache_path, ckpt_filename, mode):
+    # Returns the file to load: the snapshot when there is one (made now if needed), else the checkpoint itself.
+    if mode not in snapshot_modes:
+        return ckpt_filename
+    try:
+        if cache_path not in checked_cache_paths and os.path.isdir(cache_path):
+            checked_cache_paths.add(cache_path)
+            remove_stale_snapshots(cache_path)
+
+        dtype = target_dtype()
+        filename = snapshot_filename(cache_path, ckpt_filename, dtype)
+        if os.path.exists(filename):
+            return filename
+        if not needs_snapshot(ckpt_filename, mode, dtype):
+            return ckpt_filename
+
+        timer = time.perf_counter()
+        if not make_snapshot(ckpt_filename, filename, dtype):
+            print(f'[Model Snapshot] Not enough free space in {cache_path} for a snapshot of {ckpt_filename}')
+            return ckpt_filename
+        print(f'[Model Snapshot] Converted {ckpt_filename} in {time.perf_counter() - timer:.2f} seconds: {filename}')
+        remove_stale_snapshots(cache_path, keep=filename)
+        return filename
+    except Exception as e:
+        print(f'[Model Snapshot] Failed to make a snapshot of {ckpt_filename}: {e}')
+        return ckpt_filename
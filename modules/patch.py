@@ -1,3 +1,4 @@
+import time
 import torch
 import contextlib
 import comfy.model_base
@@ -14,6 +15,7 @@ import comfy.ldm.modules.diffusionmodules.openaimodel
 import comfy.ldm.modules.diffusionmodules.model
 import comfy.sd
 
+from collections import OrderedDict
 from comfy.model_base import sdxl_pooled
 from comfy.k_diffusion import utils
 from comfy.k_diffusion.sampling import BrownianTreeNoiseSampler, trange
@@ -23,15 +25,181 @@ from comfy.ldm.modules.diffusionmodules.openaimodel import timestep_embedding, f
 sharpness = 2.0
 negative_adm = True
 
+# The sharpness blend weight is at most 0.001 * sharpness; below this weight the filter is not worth running.
+sharpness_skip_threshold = 1e-4
+sharpness_steps = dict(filtered=0, skipped=0)
+# Host side skip decision per step of the running sampler, see set_sharpness_schedule; None filters every step.
+sharpness_schedule = None
+sharpness_step = 0
+
 comfy_encode_adm = comfy.model_base.SDXL.encode_adm
 
 cfg_x0 = 0.0
 cfg_s = 1.0
 cfg_cin = 1.0
 
+# Unit-strength LoRA products per (patch tensors, key), kept on the device they were computed on and bounded
+# by lora_products_max_bytes. A change of strengths then costs one scaled add per LoRA and key.
+lora_products = OrderedDict()
+lora_products_bytes = 0
+lora_products_max_bytes = 2048 * 2**20
+
+# LoRA products that LoraMergeEngine may compute ahead of calculate_weight_patched.
+lora_merge_ahead_bytes = 256 * 2**20
+lora_sources = {}
+lora_merge_times = {}
+# Per-LoRA merge times need a device synchronization around every timed patch, which serializes the GPU,
+# so they are only measured when profiling; otherwise the whole patch_model call is timed once.
+lora_merge_profile = False
+patch_model_original = None
+
+
+def register_lora_patches(loaded, name):
+    # The patch tuples are kept so that their ids stay unique while registered.
+    for v in loaded.values():
+        lora_sources[id(v)] = (v, name)
+
+
+def forget_lora_patches(loaded):
+    for v in loaded.values():
+        lora_sources.pop(id(v), None)
+    drop_lora_products(loaded)
+
+
+def lora_source_name(v):
+    entry = lora_sources.get(id(v), None)
+    if entry is None or entry[0] is not v:
+        return 'unknown'
+    return entry[1]
+
+
+def add_merge_time(name, seconds):
+    lora_merge_times[name] = lora_merge_times.get(name, 0.0) + seconds
+
+
+def synchronize(device):
+    # Kernels run asynchronously, so a merge is only timed correctly between two synchronizations.
+    if device is not None and device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def is_plain_lora(p):
+    v = p[1]
+    return p[2] == 1.0 and isinstance(v, tuple) and len(v) == 4 and v[3] is None
+
+
+class LoraMergeEngine:
+    # Merges the plain LoRAs (no LoCon mid weights) of a ModelPatcher on its load device. The unit-strength product
+    # U_i @ D_i of every (key, LoRA) pair is multiplied with torch.bmm together with the other pairs of equal
+    # (out, rank, in) shape, and kept in lora_products, so patching the same LoRAs again with other strengths costs
+    # one scaled add per LoRA and key. Keys with other patch types keep the per-patch path.
+    def __init__(self, patcher, device):
+        self.device = device
+        self.patches = patcher.patches
+        self.groups = {}
+        self.group_of = {}
+        self.products = {}
+        self.ahead_bytes = 0
+        for key, patches in patcher.patches.items():
+            if len(patches) == 0 or not all(is_plain_lora(p) for p in patches):
+                continue
+            for i, (_, v, _) in enumerate(patches):
+                group = (v[0].shape[0], v[1].shape[0], v[1].flatten(start_dim=1).shape[1])
+                self.groups.setdefault(group, []).append((key, i))
+                self.group_of[(key, i)] = group
+
+    def merge(self, item):
+        # The products of item and of as many pending pairs of its group as fit in lora_merge_ahead_bytes.
+        group = self.group_of[item]
+        out_features, rank, in_features = group
+        pending = [(k, i) for k, i in self.groups[group] if (k, i) != item and (k, i) not in self.products
+                   and not has_lora_product(self.patches[k][i][1], k)]
+        product_bytes = out_features * in_features * 4
+        count = max(0, min(len(pending), (lora_merge_ahead_bytes - self.ahead_bytes) // product_bytes))
+        items = [item] + pending[:count]
+        self.groups[group] = [x for x in self.groups[group] if x not in items]
+
+        if lora_merge_profile:
+            synchronize(self.device)
+            timer = time.perf_counter()
+        # Every factor belongs to one pair only, so its float32 device copy is dropped once the pair is merged.
+        ups = [comfy.model_management.cast_to_device(self.patches[k][i][1][0], self.device, torch.float32).flatten(start_dim=1) for k, i in items]
+        downs = [comfy.model_management.cast_to_device(self.patches[k][i][1][1], self.device, torch.float32).flatten(start_dim=1) for k, i in items]
+        if len(items) == 1:
+            products = torch.mm(ups[0], downs[0])[None]
+        else:
+            products = torch.bmm(torch.stack(ups), torch.stack(downs))
+        del ups, downs
+
+        result = None
+        for (k, i), product in zip(items, products):
+            product = put_lora_product(self.patches[k][i][1], k, product)
+            if (k, i) == item:
+                result = product
+            else:
+                self.products[(k, i)] = product
+                self.ahead_bytes += product.numel() * product.element_size()
+        if lora_merge_profile:
+            synchronize(self.device)
+            elapsed = time.perf_counter() - timer
+            for k, i in items:
+                add_merge_time(lora_source_name(self.patches[k][i][1]), elapsed / len(items))
+        return result
+
+    def pop(self, key, patches, weight):
+        if (key, 0) not in self.group_of or patches is not self.patches.get(key, None) or weight.device != self.device:
+            return None
+
+        delta = None
+        for i, (alpha, v, _) in enumerate(patches):
+            product = self.products.pop((key, i), None)
+            if product is not None:
+                self.ahead_bytes -= product.numel() * product.element_size()
+            else:
+                product = get_lora_product(v, key, self.device)
+            if product is None:
+                product = self.merge((key, i))
+            if product.numel() != weight.numel():
+                return None
+            if v[2] is not None:
+                alpha *= v[2] / v[1].shape[0]
+            term = alpha * product.reshape(weight.shape).to(torch.float32)
+            delta = term if delta is None else delta + term
+        return delta
+
+
+def patch_model_patched(self, *args, **kwargs):
+    device_to = kwargs.get('device_to', args[0] if len(args) > 0 else None)
+    device_to = torch.device(device_to) if device_to is not None else None
+    lora_merge_times.clear()
+    if device_to is not None and device_to.type != 'cpu':
+        self.fcs_merge_engine = LoraMergeEngine(self, device_to)
+    synchronize(device_to)
+    timer = time.perf_counter()
+    try:
+        return patch_model_original(self, *args, **kwargs)
+    finally:
+        self.fcs_merge_engine = None
+        if len(self.patches) > 0:
+            synchronize(device_to)
+            message = f'[LoRA Merge] {len(self.patches)} keys in {time.perf_counter() - timer:.2f}s'
+            if len(lora_merge_times) > 0:
+                message += ': ' + ', '.join(f'{name}: {seconds:.2f}s' for name, seconds in lora_merge_times.items())
+            print(message)
+
 
 def calculate_weight_patched(self, patches, weight, key):
+    engine = getattr(self, 'fcs_merge_engine', None)
+    if engine is not None:
+        delta = engine.pop(key, patches, weight)
+        if delta is not None:
+            weight += delta
+            return weight
+
     for p in patches:
+        if lora_merge_profile:
+            synchronize(weight.device)
+            timer = time.perf_counter()
         alpha = p[0]
         v = p[1]
         strength_model = p[2]
@@ -58,19 +226,25 @@ def calculate_weight_patched(self, patches, weight, key):
                 else:
                     weight += alpha * comfy.model_management.cast_to_device(w1, weight.device, weight.dtype)
         elif len(v) == 4: #lora/locon
-            mat1 = comfy.model_management.cast_to_device(v[0], weight.device, torch.float32)
-            mat2 = comfy.model_management.cast_to_device(v[1], weight.device, torch.float32)
             if v[2] is not None:
-                alpha *= v[2] / mat2.shape[0]
-            if v[3] is not None:
-                #locon mid weights, hopefully the math is fine because I didn't properly test it
-                mat3 = comfy.model_management.cast_to_device(v[3], weight.device, torch.float32)
-                final_shape = [mat2.shape[1], mat2.shape[0], mat3.shape[2], mat3.shape[3]]
-                mat2 = torch.mm(mat2.transpose(0, 1).flatten(start_dim=1), mat3.transpose(0, 1).flatten(start_dim=1)).reshape(final_shape).transpose(0, 1)
-            try:
-                weight += (alpha * torch.mm(mat1.flatten(start_dim=1), mat2.flatten(start_dim=1))).reshape(weight.shape).type(weight.dtype)
-            except Exception as e:
-                print("ERROR", key, e)
+                alpha *= v[2] / v[1].shape[0]
+            product = get_lora_product(v, key, weight.device)
+            if product is not None:
+                weight += alpha * product.to(weight.dtype)
+            else:
+                mat1 = comfy.model_management.cast_to_device(v[0], weight.device, torch.float32)
+                mat2 = comfy.model_management.cast_to_device(v[1], weight.device, torch.float32)
+                if v[3] is not None:
+                    #locon mid weights, hopefully the math is fine because I didn't properly test it
+                    mat3 = comfy.model_management.cast_to_device(v[3], weight.device, torch.float32)
+                    final_shape = [mat2.shape[1], mat2.shape[0], mat3.shape[2], mat3.shape[3]]
+                    mat2 = torch.mm(mat2.transpose(0, 1).flatten(start_dim=1), mat3.transpose(0, 1).flatten(start_dim=1)).reshape(final_shape).transpose(0, 1)
+                try:
+                    product = torch.mm(mat1.flatten(start_dim=1), mat2.flatten(start_dim=1)).reshape(weight.shape)
+                    weight += (alpha * product).type(weight.dtype)
+                    put_lora_product(v, key, product)
+                except Exception as e:
+                    print("ERROR", key, e)
         elif len(v) == 8: #lokr
             w1 = v[0]
             w2 = v[1]
@@ -133,9 +307,78 @@ def calculate_weight_patched(self, patches, weight, key):
                 weight += (alpha * m1 * m2).reshape(weight.shape).type(weight.dtype)
             except Exception as e:
                 print("ERROR", key, e)
+        if lora_merge_profile:
+            synchronize(weight.device)
+            add_merge_time(lora_source_name(p[1]), time.perf_counter() - timer)
     return weight
 
 
+def has_lora_product(v, key):
+    entry = lora_products.get((id(v), key), None)
+    return entry is not None and entry[0] is v
+
+
+def get_lora_product(v, key, device):
+    entry = lora_products.get((id(v), key), None)
+    if entry is None or entry[0] is not v:
+        return None
+    lora_products.move_to_end((id(v), key))
+    return entry[1].to(device)
+
+
+def put_lora_product(v, key, product):
+    # Returns the product in the dtype it is cached in, so that a stack patches to the same weights whether its
+    # products were cached or not. It is copied, a slice of a batched product would keep the whole batch alive.
+    # v is kept in the entry so that its id cannot be reused while cached.
+    global lora_products_bytes
+    product = product.to(v[0].dtype, copy=True)
+    size = product.numel() * product.element_size()
+    if size > lora_products_max_bytes:
+        return product
+    old = lora_products.pop((id(v), key), None)
+    if old is not None:
+        lora_products_bytes -= old[1].numel() * old[1].element_size()
+    lora_products[(id(v), key)] = (v, product)
+    lora_products_bytes += size
+    while lora_products_bytes > lora_products_max_bytes and len(lora_products) > 0:
+        _, (_, old_product) = lora_products.popitem(last=False)
+        lora_products_bytes -= old_product.numel() * old_product.element_size()
+    return product
+
+
+def drop_lora_products(loaded):
+    # The products of LoRA files that are no longer loaded, they would only hold device memory until evicted.
+    global lora_products_bytes
+    patches = {id(v): v for v in loaded.values()}
+    for cache_key in [k for k, (v, _) in lora_products.items() if patches.get(k[0], None) is v]:
+        _, product = lora_products.pop(cache_key)
+        lora_products_bytes -= product.numel() * product.element_size()
+
+
+def set_sharpness_schedule(model_wrap, sigmas):
+    # The blend weight (1 - t / 999) * 0.001 * sharpness only depends on the step, so the steps where it is below
+    # sharpness_skip_threshold are known from the schedule: one device to host copy per sampling call instead of one
+    # per step. Samplers with several model calls per step use the decision of the step they are in.
+    global sharpness_schedule, sharpness_step
+    timesteps = model_wrap.sigma_to_t(sigmas[:-1]).tolist()
+    sharpness_schedule = [(1.0 - t / 999.0) * 0.001 * sharpness < sharpness_skip_threshold for t in timesteps]
+    sharpness_step = 0
+    return
+
+
+def advance_sharpness_schedule(step):
+    global sharpness_step
+    sharpness_step = step + 1
+    return
+
+
+def clear_sharpness_schedule():
+    global sharpness_schedule, sharpness_step
+    sharpness_schedule = None
+    sharpness_step = 0
+    return
+
+
 def cfg_patched(args):
     global cfg_x0, cfg_s
     positive_eps = args['cond'].clone()
@@ -147,8 +390,18 @@ def cfg_patched(args):
     alpha = 1.0 - (t / 999.0)[:, None, None, None].clone()
     alpha *= 0.001 * sharpness
 
-    eps_degraded = anisotropic.adaptive_anisotropic_filter(x=positive_eps, g=positive_x0)
-    eps_degraded_weighted = eps_degraded * alpha + positive_eps * (1.0 - alpha)
+    if sharpness_schedule is not None and sharpness_step < len(sharpness_schedule):
+        skip = sharpness_schedule[sharpness_step]
+    else:
+        skip = 0.001 * sharpness < sharpness_skip_threshold
+
+    if skip:
+        sharpness_steps['skipped'] += 1
+        eps_degraded_weighted = positive_eps
+    else:
+        sharpness_steps['filtered'] += 1
+        eps_degraded = anisotropic.adaptive_anisotropic_filter(x=positive_eps, g=positive_x0)
+        eps_degraded_weighted = eps_degraded * alpha + positive_eps * (1.0 - alpha)
 
     cond = eps_degraded_weighted * cfg_s + cfg_x0
 
@@ -241,19 +494,83 @@ def encode_token_weights_patched_with_a1111_method(self, token_weight_pairs):
     return torch.cat(output, dim=-2).cpu(), first_pooled.cpu()
 
 
+def encode_token_weights_batched_with_a1111_method(self, token_weight_pairs_list):
+    # Same result as encode_token_weights_patched_with_a1111_method for every prompt,
+    # but the 77-token chunks of all prompts go through the text encoder as one batch.
+    to_encode = list(self.empty_tokens)
+    sections = []
+    for token_weight_pairs in token_weight_pairs_list:
+        start = len(to_encode)
+        for x in token_weight_pairs:
+            to_encode.append(list(map(lambda a: a[0], x)))
+        sections.append((start, len(to_encode)))
+
+    out, pooled = self.encode(to_encode)
+
+    z_empty = out[0:1]
+    results = []
+    for token_weight_pairs, (start, end) in zip(token_weight_pairs_list, sections):
+        first_pooled = pooled[start:start + 1] if end > start else pooled[0:1]
+
+        output = []
+        for k in range(start, end):
+            z = out[k:k + 1]
+            original_mean = z.mean()
+            weights = torch.tensor([w for _, w in token_weight_pairs[k - start]], dtype=z.dtype, device=z.device)
+            z = (z - z_empty) * weights[None, :, None] + z_empty
+            new_mean = z.mean()
+            z = z * (original_mean / new_mean)
+            output.append(z)
+
+        if len(output) == 0:
+            results.append((z_empty.cpu(), first_pooled.cpu()))
+        else:
+            results.append((torch.cat(output, dim=-2).cpu(), first_pooled.cpu()))
+    return results
+
+
+def encode_token_weights_batched(cond_stage_model, tokens_list):
+    # SDXL base encodes with clip_l and clip_g, SDXL refiner only with clip_g, SD 1.x/2.x tokens are plain lists.
+    if isinstance(tokens_list[0], dict):
+        outputs = {}
+        for name in ['g', 'l']:
+            if name in tokens_list[0]:
+                encoder = getattr(cond_stage_model, f'clip_{name}')
+                outputs[name] = encode_token_weights_batched_with_a1111_method(encoder, [t[name] for t in tokens_list])
+        if 'g' in outputs and 'l' in outputs:
+            return [(torch.cat([l_out, g_out], dim=-1), g_pooled)
+                    for (l_out, _), (g_out, g_pooled) in zip(outputs['l'], outputs['g'])]
+        if 'g' in outputs and len(outputs) == 1:
+            return outputs['g']
+        return [cond_stage_model.encode_token_weights(t) for t in tokens_list]
+
+    if isinstance(cond_stage_model, comfy.sd1_clip.ClipTokenWeightEncoder):
+        return encode_token_weights_batched_with_a1111_method(cond_stage_model, tokens_list)
+
+    return [cond_stage_model.encode_token_weights(t) for t in tokens_list]
+
+
 @torch.no_grad()
 def sample_dpmpp_fooocus_2m_sde_inpaint_seamless(model, x, sigmas, extra_args=None, callback=None, disable=None, eta=1., s_noise=1., noise_sampler=None, **kwargs):
     sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
     noise_sampler = BrownianTreeNoiseSampler(x, sigma_min, sigma_max, seed=extra_args.get("seed", None), cpu=False) if noise_sampler is None else noise_sampler
 
     seed = extra_args.get("seed", None)
-    assert isinstance(seed, int)
+    assert isinstance(seed, (int, list))
 
-    energy_generator = torch.Generator(device='cpu')
-    energy_generator.manual_seed(seed + 1)  # avoid bad results by using different seeds.
+    # batched sampling passes one seed per sample
+    seeds = seed if isinstance(seed, list) else [seed]
+    energy_generators = []
+    for s in seeds:
+        energy_generator = torch.Generator(device='cpu')
+        energy_generator.manual_seed(s + 1)  # avoid bad results by using different seeds.
+        energy_generators.append(energy_generator)
 
     def get_energy():
-        return torch.randn(x.size(), dtype=x.dtype, generator=energy_generator, device="cpu").to(x)
+        if len(energy_generators) == 1:
+            return torch.randn(x.size(), dtype=x.dtype, generator=energy_generators[0], device="cpu").to(x)
+        return torch.cat([torch.randn(x[i:i + 1].size(), dtype=x.dtype, generator=g, device="cpu")
+                          for i, g in enumerate(energy_generators)], dim=0).to(x)
 
     sigma_min, sigma_max = sigmas[sigmas > 0].min(), sigmas.max()
     noise_sampler = BrownianTreeNoiseSampler(x, sigma_min, sigma_max, seed=seed, cpu=True) if noise_sampler is None else noise_sampler
@@ -452,6 +769,10 @@ def patch_all():
 
 #    comfy.sd1_clip.SD1ClipModel.forward = patched_SD1ClipModel_forward
 
+    global patch_model_original
+    if patch_model_original is None:
+        patch_model_original = comfy.model_patcher.ModelPatcher.patch_model
+    comfy.model_patcher.ModelPatcher.patch_model = patch_model_patched
     comfy.model_patcher.ModelPatcher.calculate_weight = calculate_weight_patched
     comfy.ldm.modules.diffusionmodules.openaimodel.UNetModel.forward = patched_unet_forward
 
@@ -2,6 +2,8 @@ import os
 import json
 
 from modules.model_loader import load_file_from_url
+from modules.file_inventory import FileInventory
+from modules.model_index import ModelIndex, base_architectures, refiner_architectures
 
 
 def load_paths(paths_filename):
@@ -17,7 +19,8 @@ def load_paths(paths_filename):
         'inpaint_models_path': '../models/inpaint/',
         'styles_path': '../sdxl_styles/',
         'wildcards_path': '../wildcards/',
-        'temp_outputs_path': '../outputs/'
+        'temp_outputs_path': '../outputs/',
+        'cache_path': '../cache/'
     }
 
     if os.path.exists(paths_filename):
@@ -48,6 +51,8 @@ def load_paths(paths_filename):
                     paths_dict['wildcards_path'] = paths_obj['path_wildcards']
                 if 'path_outputs' in paths_obj:
                     paths_dict['temp_outputs_path'] = paths_obj['path_outputs']
+                if 'path_cache' in paths_obj:
+                    paths_dict['cache_path'] = paths_obj['path_cache']
 
             except Exception as e:
                 print('load_paths, e: ' + str(e))
@@ -101,6 +106,7 @@ fooocus_expansion_path = get_config_or_set_default('fooocus_expansion_path',
 
 temp_outputs_path = get_config_or_set_default('temp_outputs_path', '../outputs/')
 last_prompt_path = os.path.join(temp_outputs_path, 'last_prompt.json')
+cache_path = get_config_or_set_default('cache_path', '../cache/')
 
 with open(config_path, "w", encoding="utf-8") as json_file:
     json.dump(config_dict, json_file, indent=4)
@@ -116,41 +122,54 @@ default_controlnet_canny_name = 'control-lora-canny-rank128.safetensors'
 default_controlnet_depth_name = 'control-lora-depth-rank128.safetensors'
 default_lora_weight = 0.5
 
+# Listings of the model, LoRA, controlnet and style folders; unchanged directories are not listed again.
+inventory = FileInventory()
+
+# Headers of the files in modelfile_path and lorafile_path, see modules/model_index.py.
+model_index = ModelIndex(os.path.join(cache_path, 'model_index.json'))
+
+model_extensions = ['.pth', '.ckpt', '.bin', '.safetensors']
 model_filenames = []
+base_model_filenames = []
+refiner_model_filenames = []
 lora_filenames = []
 canny_filenames = []
 depth_filenames = []
 
 
+def filter_filenames(filenames, exensions=None, name_filter=None):
+    result = []
+    for path in filenames:
+        _, file_extension = os.path.splitext(os.path.basename(path))
+        if (exensions == None or file_extension.lower() in exensions) and (name_filter == None or name_filter in _):
+            result.append(path)
+    return sorted(result, key=lambda x: -1 if os.sep in x else 1)
+
+
 def get_files_from_folder(folder_path, exensions=None, name_filter=None):
     if not os.path.isdir(folder_path):
         raise ValueError("Folder path is not a valid directory.")
 
-    filenames = []
-
-    for root, dirs, files in os.walk(folder_path):
-        relative_path = os.path.relpath(root, folder_path)
-        if relative_path == ".":
-            relative_path = ""
-        for filename in files:
-            _, file_extension = os.path.splitext(filename)
-            if (exensions == None or file_extension.lower() in exensions) and (name_filter == None or name_filter in _):
-                path = os.path.join(relative_path, filename)
-                filenames.append(path)
-
-    return sorted(filenames, key=lambda x: -1 if os.sep in x else 1)
+    return filter_filenames(inventory.files(folder_path).keys(), exensions, name_filter)
 
 
 def get_model_filenames(folder_path, name_filter=None):
-    return get_files_from_folder(folder_path, ['.pth', '.ckpt', '.bin', '.safetensors'], name_filter)
+    return get_files_from_folder(folder_path, model_extensions, name_filter)
 
 
 def update_all_model_names():
-    global model_filenames, lora_filenames, canny_filenames, depth_filenames
-    model_filenames = get_model_filenames(modelfile_path)
-    lora_filenames = get_model_filenames(lorafile_path)
-    canny_filenames = get_model_filenames(controlnet_path, 'control-lora-canny')
-    depth_filenames = get_model_filenames(controlnet_path, 'control-lora-depth')
+    # One inventory pass per folder: the listings, and the (mtime, size) the model index is validated with.
+    global model_filenames, base_model_filenames, refiner_model_filenames, lora_filenames, canny_filenames, depth_filenames
+    model_files = inventory.files(modelfile_path)
+    model_filenames = filter_filenames(model_files.keys(), model_extensions)
+    base_model_filenames = model_index.filter(modelfile_path, model_filenames, ['checkpoint'], base_architectures, model_files)
+    refiner_model_filenames = model_index.filter(modelfile_path, model_filenames, ['checkpoint'], refiner_architectures, model_files)
+    lora_files = inventory.files(lorafile_path)
+    lora_filenames = model_index.filter(lorafile_path, filter_filenames(lora_files.keys(), model_extensions), ['lora'],
+                                        base_architectures + refiner_architectures, lora_files)
+    controlnet_filenames = inventory.files(controlnet_path).keys()
+    canny_filenames = filter_filenames(controlnet_filenames, model_extensions, 'control-lora-canny')
+    depth_filenames = filter_filenames(controlnet_filenames, model_extensions, 'control-lora-depth')
     return
 
 
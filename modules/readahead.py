@@ -0,0 +1,140 @@
+import os
+import mmap
+import time
+import queue
+import ctypes
+import ctypes.util
+import psutil
+import threading
+
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+except Exception:
+    libc = None
+
+
+def resident_fraction(filename, size):
+    # Fraction of the pages of the file that are in the page cache (mincore), or None where that is not available.
+    if libc is None or size == 0:
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            # A private mapping is writable for ctypes, its pages are the page cache pages until they are written.
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        try:
+            pointer = ctypes.c_char.from_buffer(buffer)
+            pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            vector = (ctypes.c_ubyte * pages)()
+            result = libc.mincore(ctypes.addressof(pointer), size, vector)
+            del pointer
+            if result != 0:
+                return None
+            data = bytes(vector)
+            return (pages - data.count(0)) / pages
+        finally:
+            buffer.close()
+    except (OSError, ValueError):
+        return None
+
+
+class PageCacheWarmer:
+    # Reads model files into the OS page cache on a background thread, so that a later safe_open or
+    # load_torch_file of the same file does not wait for a cold (network) volume.
+    #   'fadvise': asks the kernel to read the files ahead (posix_fadvise WILLNEED), no bandwidth control,
+    #   'read': sequential reads in chunks, limited to max_bytes_per_second.
+    # A warmed file is warmed again once the kernel evicted its pages (less than min_resident_fraction of them are
+    # cached); where residency cannot be checked, once warmed_seconds have passed.
+    def __init__(self, mode='read', max_bytes_per_second=200 * 2**20, chunk_bytes=8 * 2**20, max_ram_fraction=0.5,
+                 min_resident_fraction=0.9, warmed_seconds=600):
+        if mode == 'fadvise' and not hasattr(os, 'posix_fadvise'):
+            mode = 'read'
+        self.mode = mode
+        self.max_bytes_per_second = max_bytes_per_second
+        self.chunk_bytes = chunk_bytes
+        self.max_ram_fraction = max_ram_fraction
+        self.min_resident_fraction = min_resident_fraction
+        self.warmed_seconds = warmed_seconds
+        self.requests = queue.Queue()
+        self.generation = 0
+        self.warmed = {}
+        self.total_bytes = 0
+        self.thread = None
+
+    def warm(self, filenames):
+        # A new request replaces the files that are still waiting from the previous one.
+        if self.mode not in ['fadvise', 'read']:
+            return
+        self.generation += 1
+        self.requests.put((self.generation, [f for f in filenames if f is not None and os.path.isfile(f)]))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    def worker(self):
+        while True:
+            generation, filenames = self.requests.get()
+            if generation != self.generation:
+                continue
+            timer = time.perf_counter()
+            budget = psutil.virtual_memory().available * self.max_ram_fraction
+            warmed_files = 0
+            warmed_bytes = 0
+            for filename in filenames:
+                try:
+                    size = os.path.getsize(filename)
+                    mtime = os.path.getmtime(filename)
+                    if self.is_warm(filename, mtime, size):
+                        continue
+                    if warmed_bytes + size > budget:
+                        break
+                    if self.mode == 'fadvise':
+                        done = self.fadvise(filename, size)
+                    else:
+                        done = self.read(filename, generation)
+                    warmed_bytes += done
+                    if done < size:
+                        break
+                    self.warmed[filename] = (mtime, time.time())
+                    warmed_files += 1
+                except Exception as e:
+                    print(f'[Readahead] Failed to warm {filename}: {e}')
+            self.total_bytes += warmed_bytes
+            if warmed_bytes > 0:
+                print(f'[Readahead] {self.mode}: {warmed_files} files, {warmed_bytes / 2**30:.2f} GB in '
+                      f'{time.perf_counter() - timer:.1f}s, total = {self.total_bytes / 2**30:.2f} GB')
+
+    def is_warm(self, filename, mtime, size):
+        warmed = self.warmed.get(filename, None)
+        if warmed is None or warmed[0] != mtime:
+            return False
+        fraction = resident_fraction(filename, size)
+        if fraction is None:
+            return time.time() - warmed[1] < self.warmed_seconds
+        return fraction >= self.min_resident_fraction
+
+    def fadvise(self, filename, size):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+        return size
+
+    def read(self, filename, generation):
+        done = 0
+        with open(filename, 'rb', buffering=0) as f:
+            timer = time.perf_counter()
+            while True:
+                if generation != self.generation:
+                    # A newer request is waiting; it decides again what is worth reading.
+                    return done
+                data = f.read(self.chunk_bytes)
+                if not data:
+                    return done
+                done += len(data)
+                if self.max_bytes_per_second > 0:
+                    ahead = done / self.max_bytes_per_second - (time.perf_counter() - timer)
+                    if ahead > 0:
+                        time.sleep(ahead)
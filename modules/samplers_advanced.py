@@ -1,7 +1,9 @@
 from comfy.samplers import *
 
+import time
 import comfy.model_management
 import modules.virtual_memory
+import modules.patch
 
 
 class KSamplerBasic:
@@ -138,6 +140,8 @@ class KSamplerBasic:
         else:
             max_denoise = True
 
+        modules.patch.clear_sharpness_schedule()
+
 
         if self.sampler == "uni_pc":
             samples = uni_pc.sample_unipc(self.model_wrap, noise, latent_image, sigmas, sampling_function=sampling_function, max_denoise=max_denoise, extra_args=extra_args, noise_mask=denoise_mask, callback=callback, disable=disable_pbar)
@@ -187,10 +191,16 @@ class KSamplerBasic:
             else:
                 noise = noise * sigmas[0]
 
-            k_callback = None
             total_steps = len(sigmas) - 1
-            if callback is not None:
-                k_callback = lambda x: callback(x["i"], x["denoised"], x["x"], total_steps)
+
+            def k_callback(x):
+                modules.patch.advance_sharpness_schedule(x["i"])
+                if callback is not None:
+                    callback(x["i"], x["denoised"], x["x"], total_steps)
+
+            if self.sampler not in ["dpm_fast", "dpm_adaptive"]:
+                # These two choose their own steps, the filter then runs at every step.
+                modules.patch.set_sharpness_schedule(self.model_wrap, sigmas)
 
             if latent_image is not None:
                 noise += latent_image
@@ -201,6 +211,7 @@ class KSamplerBasic:
             else:
                 samples = getattr(k_diffusion_sampling, "sample_{}".format(self.sampler))(self.model_k, noise, sigmas, extra_args=extra_args, callback=k_callback, disable=disable_pbar)
 
+        modules.patch.clear_sharpness_schedule()
         return self.model.process_latent_out(samples.to(torch.float32))
 
 
@@ -354,7 +365,11 @@ class KSamplerWithRefiner:
             refiner_negative = encode_adm(self.refiner_model, refiner_negative, noise.shape[0],
                                           noise.shape[3], noise.shape[2], self.device, "negative")
 
+        sampling_start_time = time.perf_counter()
+        modules.virtual_memory.prefetch_from_virtual_memory(self.refiner_model_denoise.inner_model)
+
         def refiner_switch():
+            switch_start_time = time.perf_counter()
             modules.virtual_memory.try_move_to_virtual_memory(self.model_denoise.inner_model)
             modules.virtual_memory.load_from_virtual_memory(self.refiner_model_denoise.inner_model)
             comfy.model_management.load_model_gpu(self.refiner_model_patcher)
@@ -363,7 +378,8 @@ class KSamplerWithRefiner:
                 positive[i] = refiner_positive[i]
             for i in range(len(negative)):
                 negative[i] = refiner_negative[i]
-            print('Refiner swapped.')
+            print(f'Refiner swapped: base sampling = {switch_start_time - sampling_start_time:.2f}s, '
+                  f'switch = {time.perf_counter() - switch_start_time:.2f}s')
             return
 
         def callback(step, x0, x, total_steps):
@@ -400,6 +416,8 @@ class KSamplerWithRefiner:
         else:
             max_denoise = True
 
+        modules.patch.clear_sharpness_schedule()
+
         if self.sampler == "uni_pc":
             samples = uni_pc.sample_unipc(self.model_wrap, noise, latent_image, sigmas,
                                           sampling_function=sampling_function, max_denoise=max_denoise,
@@ -422,10 +440,16 @@ class KSamplerWithRefiner:
             else:
                 noise = noise * sigmas[0]
 
-            k_callback = None
             total_steps = len(sigmas) - 1
-            if callback is not None:
-                k_callback = lambda x: callback(x["i"], x["denoised"], x["x"], total_steps)
+
+            def k_callback(x):
+                modules.patch.advance_sharpness_schedule(x["i"])
+                if callback is not None:
+                    callback(x["i"], x["denoised"], x["x"], total_steps)
+
+            if self.sampler not in ["dpm_fast", "dpm_adaptive"]:
+                # These two choose their own steps, the filter then runs at every step.
+                modules.patch.set_sharpness_schedule(self.model_wrap, sigmas)
 
             if latent_image is not None:
                 noise += latent_image
@@ -443,4 +467,5 @@ class KSamplerWithRefiner:
                                                                                           callback=k_callback,
                                                                                           disable=disable_pbar)
 
+        modules.patch.clear_sharpness_schedule()
         return self.model.process_latent_out(samples.to(torch.float32))
@@ -70,6 +70,31 @@ def load_settings():
     settings['freeu_b2'] = 1.02
     settings['freeu_s1'] = 0.99
     settings['freeu_s2'] = 0.95
+    settings['sampling_batch_size'] = 1
+    settings['refiner_swap_per_job'] = False
+    settings['cond_cache_size_mb'] = 256
+    settings['cond_cache_disk'] = False
+    settings['expansion_clip_budget'] = True
+    settings['expansion_max_phrases'] = 0
+    settings['sharpness_filter'] = 'bilateral'
+    settings['sharpness_skip_threshold'] = 1e-4
+    settings['model_cache_size_mb'] = 0
+    settings['model_cache_max_models'] = 4
+    settings['lora_cache_size_mb'] = 2048
+    settings['lora_cache_max_entries'] = 8
+    settings['lora_delta_cache_mb'] = 2048
+    settings['lora_bake_cache'] = 'off'
+    settings['vm_load_threads'] = 4
+    settings['vm_pin_memory'] = False
+    settings['vm_mmap'] = False
+    settings['vm_policy'] = 'legacy'
+    settings['vm_policy_margin_mb'] = 2048
+    settings['readahead_mode'] = 'off'
+    settings['readahead_mb_per_s'] = 200
+    settings['background_startup'] = True
+    settings['model_snapshots'] = 'off'
+    settings['lora_file_cache_mb'] = 4096
+    settings['lora_merge_profile'] = False
 
     if exists('settings.json'):
         with open('settings.json') as settings_file:
@@ -1,7 +1,13 @@
+import os
+import json
+import mmap
+import struct
 import torch
 import time
 import gc
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from safetensors import safe_open
 from comfy import model_management
 from comfy.diffusers_convert import textenc_conversion_lst
@@ -24,6 +30,43 @@ else:
 
 print(f'[Virtual Memory System] Activated = {global_virtual_memory_activated}')
 
+# How try_move_to_virtual_memory decides, per model and per call:
+#   'auto': offload when the free memory of the logic target, minus what is about to be loaded back, is below
+#           policy_margin_bytes; cheap to reload models are also offloaded when the headroom is small,
+#   'keep_both': never offload, 'offload_refiner': only offload the refiner, 'offload_all': always offload,
+#   'legacy': the behaviour before these policies, global_virtual_memory_activated above. With ALWAYS_USE_VM = False
+#             that never offloads; the RAM/VRAM thresholds only apply when ALWAYS_USE_VM is None.
+# 'legacy' is the default; 'auto' turns offloading on where the legacy behaviour never offloads.
+policy_modes = ['auto', 'keep_both', 'offload_refiner', 'offload_all', 'legacy']
+policy_mode = 'legacy'
+policy_margin_bytes = 2048 * 2**20
+policy_cheap_reload_seconds = 0.5
+# Measured reload speed in bytes per second, per checkpoint file.
+reload_speed = {}
+
+# Background loads started by prefetch_from_virtual_memory: id(model) -> (model, thread, start time).
+prefetch_jobs = {}
+
+# Threads reading tensors back in load_from_virtual_memory; 1 keeps the serial loader.
+load_threads = 4
+# Stage GPU-bound tensors in pinned host buffers so that the host to device copies can run asynchronously.
+pin_memory = False
+
+# For models that live on the CPU, parameters become copy-on-write views of the memory-mapped safetensors file:
+# moving to virtual memory only drops the references and loading back creates views without reading anything.
+mmap_mode = False
+mmap_files = {}
+
+# Key translation indexes are written next to the checkpoint, or here if that folder is not writable.
+index_fallback_path = None
+# Indexes written with another version used an older translate_key.
+key_index_version = 2
+
+safetensors_dtypes = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
 
 @torch.no_grad()
 def recursive_set(obj, key, value):
@@ -67,6 +110,118 @@ def only_load_safetensors_keys(filename):
         return None
 
 
+def translate_clip_g_key(key, embedder):
+    # OpenCLIP G is stored in the original format, with q, k and v fused in in_proj.
+    current_flag = None
+    current_key_in_safetensors = key
+
+    for a, b in textenc_conversion_lst:
+        current_key_in_safetensors = current_key_in_safetensors.replace(b, a)
+
+    model_prefix = f'conditioner.embedders.{embedder}.model.'
+    current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.transformer.text_model.encoder.layers.', model_prefix + 'transformer.resblocks.')
+    current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.text_projection', model_prefix + 'text_projection')
+    current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.logit_scale', model_prefix + 'logit_scale')
+    current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.', model_prefix)
+
+    for e in ["weight", "bias"]:
+        for i, k in enumerate(['q', 'k', 'v']):
+            e_flag = f'.{k}_proj.{e}'
+            if current_key_in_safetensors.endswith(e_flag):
+                current_key_in_safetensors = current_key_in_safetensors[:-len(e_flag)] + f'.in_proj_{e}'
+                current_flag = (1280 * i, 1280 * (i + 1))
+    return current_key_in_safetensors, current_flag
+
+
+def translate_key(key, prefix):
+    # State dict key of the model to (key in the checkpoint, row slice of a fused tensor or None).
+    if prefix == 'refiner_clip':
+        return translate_clip_g_key(key, 0)
+    if prefix == 'base_clip':
+        # SDXL: CLIP L (transformers format) is embedder 0 and OpenCLIP G embedder 1; SD 1.x: the CLIP L of cond_stage_model.
+        if key.startswith('clip_g.'):
+            return translate_clip_g_key(key, 1)
+        if key.startswith('clip_l.'):
+            return 'conditioner.embedders.0.' + key[len('clip_l.'):], None
+        return 'cond_stage_model.' + key, None
+    return prefix + '.' + key, None
+
+
+def key_index_filename(filename, prefix, fallback=False):
+    if fallback:
+        name = os.path.basename(filename) + f'.{prefix}.vmindex.json'
+        return os.path.join(index_fallback_path, name)
+    return filename + f'.{prefix}.vmindex.json'
+
+
+def read_key_index(filename, prefix):
+    candidates = [key_index_filename(filename, prefix)]
+    if index_fallback_path is not None:
+        candidates.append(key_index_filename(filename, prefix, fallback=True))
+    for index_filename in candidates:
+        if not os.path.exists(index_filename):
+            continue
+        try:
+            with open(index_filename, 'r', encoding='utf-8') as f:
+                key_index = json.load(f)
+            if key_index.get('version', 1) == key_index_version and \
+                    key_index['mtime'] == os.path.getmtime(filename) and key_index['size'] == os.path.getsize(filename):
+                key_index['keys'] = {k: (v[0], tuple(v[1]) if v[1] is not None else None) for k, v in key_index['keys'].items()}
+                return key_index
+        except Exception as e:
+            print(f'[Virtual Memory System] Failed to read {index_filename}: {e}')
+    return None
+
+
+def write_key_index(filename, prefix, key_index):
+    candidates = [key_index_filename(filename, prefix)]
+    if index_fallback_path is not None:
+        candidates.append(key_index_filename(filename, prefix, fallback=True))
+    for index_filename in candidates:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index_filename)), exist_ok=True)
+            with open(index_filename, 'w', encoding='utf-8') as f:
+                json.dump(key_index, f)
+            return
+        except OSError as e:
+            print(f'[Virtual Memory System] Failed to write {index_filename}: {e}')
+    return
+
+
+def get_key_index(model, filename, prefix, state_dict_keys):
+    # The translation only depends on (checkpoint, prefix), so it is computed once and kept in a sidecar file.
+    key_index = getattr(model, 'virtual_memory_key_index', None)
+    if key_index is None:
+        key_index = read_key_index(filename, prefix)
+    if key_index is not None and all(k in key_index['keys'] or k in key_index['unmatched'] for k in state_dict_keys):
+        model.virtual_memory_key_index = key_index
+        return key_index
+
+    safetensors_keys = only_load_safetensors_keys(filename)
+    if safetensors_keys is None:
+        return None
+    safetensors_keys = set(safetensors_keys)
+
+    keys = {}
+    unmatched = []
+    for k in state_dict_keys:
+        current_key_in_safetensors, current_flag = translate_key(k, prefix)
+        if current_key_in_safetensors in safetensors_keys:
+            keys[k] = (current_key_in_safetensors, current_flag)
+        else:
+            unmatched.append(k)
+
+    if len(unmatched) > 0:
+        print(f'[Virtual Memory System] {len(unmatched)} keys of {prefix} are not in {filename} and stay in memory: '
+              f'{", ".join(unmatched[:8])}{", ..." if len(unmatched) > 8 else ""}')
+
+    key_index = dict(version=key_index_version, mtime=os.path.getmtime(filename), size=os.path.getsize(filename), prefix=prefix,
+                     keys=keys, unmatched=unmatched)
+    write_key_index(filename, prefix, key_index)
+    model.virtual_memory_key_index = key_index
+    return key_index
+
+
 @torch.no_grad()
 def move_to_virtual_memory(model, comfy_unload=True):
     timer = time.time()
@@ -74,6 +229,9 @@ def move_to_virtual_memory(model, comfy_unload=True):
     if comfy_unload:
         model_management.cleanup_models()
 
+    if id(model) in prefetch_jobs:
+        wait_for_prefetch(model)
+
     virtual_memory_dict = getattr(model, 'virtual_memory_dict', None)
     if isinstance(virtual_memory_dict, dict):
         # Already in virtual memory.
@@ -85,17 +243,13 @@ def move_to_virtual_memory(model, comfy_unload=True):
     filename = model_file['filename']
     prefix = model_file['prefix']
 
-    if hasattr(model, 'virtual_memory_safetensors_keys'):
-        safetensors_keys = model.virtual_memory_safetensors_keys
-    else:
-        safetensors_keys = only_load_safetensors_keys(filename)
-        model.virtual_memory_safetensors_keys = safetensors_keys
+    sd = model.state_dict()
+    key_index = get_key_index(model, filename, prefix, list(sd.keys()))
 
-    if safetensors_keys is None:
+    if key_index is None:
         print(f'[Virtual Memory System] Error: The Virtual Memory System currently only support safetensors models!')
         return
 
-    sd = model.state_dict()
     original_device = list(sd.values())[0].device.type
     model_file['original_device'] = original_device
 
@@ -103,33 +257,14 @@ def move_to_virtual_memory(model, comfy_unload=True):
 
     for k, v in sd.items():
         current_key = k
-        current_flag = None
-        if prefix == 'refiner_clip':
-            current_key_in_safetensors = k
-
-            for a, b in textenc_conversion_lst:
-                current_key_in_safetensors = current_key_in_safetensors.replace(b, a)
-
-            current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.transformer.text_model.encoder.layers.', 'conditioner.embedders.0.model.transformer.resblocks.')
-            current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.text_projection', 'conditioner.embedders.0.model.text_projection')
-            current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.logit_scale', 'conditioner.embedders.0.model.logit_scale')
-            current_key_in_safetensors = current_key_in_safetensors.replace('clip_g.', 'conditioner.embedders.0.model.')
-
-            for e in ["weight", "bias"]:
-                for i, k in enumerate(['q', 'k', 'v']):
-                    e_flag = f'.{k}_proj.{e}'
-                    if current_key_in_safetensors.endswith(e_flag):
-                        current_key_in_safetensors = current_key_in_safetensors[:-len(e_flag)] + f'.in_proj_{e}'
-                        current_flag = (1280 * i, 1280 * (i + 1))
-        else:
-            current_key_in_safetensors = prefix + '.' + k
+        translated = key_index['keys'].get(current_key, None)
         current_device = torch.device(index=v.device.index, type=v.device.type)
-        if current_key_in_safetensors in safetensors_keys:
+        if translated is not None:
+            current_key_in_safetensors, current_flag = translated
             virtual_memory_dict[current_key] = (current_key_in_safetensors, current_device, current_flag)
             recursive_del(model, current_key)
-        else:
-            # print(f'[Virtual Memory System] Missed key: {current_key}')
-            pass
+
+    model.virtual_memory_bytes = sum(v.numel() * v.element_size() for k, v in sd.items() if k in virtual_memory_dict)
 
     del sd
     gc.collect()
@@ -145,6 +280,10 @@ def move_to_virtual_memory(model, comfy_unload=True):
 def load_from_virtual_memory(model):
     timer = time.time()
 
+    job = prefetch_jobs.get(id(model), None)
+    if job is not None and job[0] is model and job[1] is not threading.current_thread():
+        wait_for_prefetch(model)
+
     virtual_memory_dict = getattr(model, 'virtual_memory_dict', None)
     if not isinstance(virtual_memory_dict, dict):
         # Not in virtual memory.
@@ -156,7 +295,71 @@ def load_from_virtual_memory(model):
     filename = model_file['filename']
     prefix = model_file['prefix']
     original_device = model_file['original_device']
+    size = getattr(model, 'virtual_memory_bytes', 0)
+
+    if mmap_mode and all(current_device.type == 'cpu' for _, current_device, _ in virtual_memory_dict.values()):
+        load_mmap(model, filename, virtual_memory_dict)
+    elif load_threads > 1:
+        load_parallel(model, filename, virtual_memory_dict, load_threads)
+    else:
+        load_serial(model, filename, virtual_memory_dict, original_device)
+
+    elapsed = time.time() - timer
+    if size > 0 and elapsed > 0:
+        reload_speed[filename] = size / elapsed
+
+    print(f'[Virtual Memory System] time = {str("%.5f" % elapsed)}s: {prefix} loaded to {original_device}: {filename}')
+    del model.virtual_memory_dict
+    return
+
+
+def read_header(f):
+    # The JSON header of an open safetensors file and the offset of its tensor data.
+    header_size = struct.unpack('<Q', f.read(8))[0]
+    return json.loads(f.read(header_size)), 8 + header_size
+
+
+def open_mmap(filename):
+    mtime = os.path.getmtime(filename)
+    entry = mmap_files.get(filename, None)
+    if entry is not None and entry[3] == mtime:
+        return entry
+
+    with open(filename, 'rb') as f:
+        header, data_start = read_header(f)
+        # ACCESS_COPY is a private mapping, so the views are writable without ever touching the file.
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    entry = (buffer, header, data_start, mtime)
+    mmap_files[filename] = entry
+    return entry
+
+
+def mmap_tensor(buffer, info, data_start):
+    # A view of one tensor of a mapped safetensors file, info is its header entry.
+    dtype = safetensors_dtypes[info['dtype']]
+    begin, end = info['data_offsets']
+    count = (end - begin) // torch.tensor([], dtype=dtype).element_size()
+    if count == 0:
+        return torch.empty(info['shape'], dtype=dtype)
+    return torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + begin).view(info['shape'])
 
+
+@torch.no_grad()
+def load_mmap(model, filename, virtual_memory_dict):
+    buffer, header, data_start, _ = open_mmap(filename)
+    for current_key, (current_key_in_safetensors, current_device, current_flag) in virtual_memory_dict.items():
+        tensor = mmap_tensor(buffer, header[current_key_in_safetensors], data_start)
+        if isinstance(current_flag, tuple) and len(current_flag) == 2:
+            # The q, k and v parts of in_proj are rows of the fused tensor, so the slice is still a view.
+            a, b = current_flag
+            tensor = tensor[a:b]
+        parameter = torch.nn.Parameter(tensor, requires_grad=False)
+        recursive_set(model, current_key, parameter)
+    return
+
+
+@torch.no_grad()
+def load_serial(model, filename, virtual_memory_dict, original_device):
     with safe_open(filename, framework="pt", device=original_device) as f:
         for current_key, (current_key_in_safetensors, current_device, current_flag) in virtual_memory_dict.items():
             tensor = f.get_tensor(current_key_in_safetensors).to(current_device)
@@ -165,21 +368,190 @@ def load_from_virtual_memory(model):
                 tensor = tensor[a:b]
             parameter = torch.nn.Parameter(tensor, requires_grad=False)
             recursive_set(model, current_key, parameter)
-
-    print(f'[Virtual Memory System] time = {str("%.5f" % (time.time() - timer))}s: {prefix} loaded to {original_device}: {filename}')
-    del model.virtual_memory_dict
     return
 
 
 @torch.no_grad()
-def try_move_to_virtual_memory(model, comfy_unload=True):
-    if not global_virtual_memory_activated:
+def load_parallel(model, filename, virtual_memory_dict, threads):
+    items = list(virtual_memory_dict.items())
+
+    # Shapes and dtypes come from the header, so every target can be a view of one buffer per (device, dtype).
+    # They are read from the JSON header directly, safetensors 0.3.1 has no get_dtype on its slices.
+    with open(filename, 'rb') as f:
+        header, _ = read_header(f)
+    layout = []
+    sizes = {}
+    for current_key, (current_key_in_safetensors, current_device, current_flag) in items:
+        info = header[current_key_in_safetensors]
+        shape = list(info['shape'])
+        dtype = safetensors_dtypes[info['dtype']]
+        if isinstance(current_flag, tuple) and len(current_flag) == 2:
+            a, b = current_flag
+            shape[0] = min(b, shape[0]) - a
+        numel = 1
+        for n in shape:
+            numel *= n
+        group = (str(current_device), dtype)
+        layout.append((group, sizes.get(group, 0), numel, shape))
+        sizes[group] = sizes.get(group, 0) + numel
+
+    buffers = {group: torch.empty(size, dtype=group[1], device=group[0]) for group, size in sizes.items()}
+    targets = [buffers[group][offset:offset + numel].view(shape) for group, offset, numel, shape in layout]
+    del buffers
+
+    def load_shard(indices):
+        staging = None
+        stream = None
+        with safe_open(filename, framework="pt", device='cpu') as f:
+            for i in indices:
+                current_key_in_safetensors, current_device, current_flag = items[i][1]
+                tensor = f.get_tensor(current_key_in_safetensors)
+                if isinstance(current_flag, tuple) and len(current_flag) == 2:
+                    a, b = current_flag
+                    tensor = tensor[a:b]
+                target = targets[i]
+                if pin_memory and target.is_cuda:
+                    size = tensor.numel() * tensor.element_size()
+                    if staging is None or staging.numel() < size:
+                        staging = torch.empty(size, dtype=torch.uint8).pin_memory()
+                        stream = torch.cuda.Stream(device=target.device)
+                    staged = staging[:size].view(tensor.dtype).view(tensor.shape)
+                    staged.copy_(tensor)
+                    with torch.cuda.stream(stream):
+                        target.copy_(staged, non_blocking=True)
+                    stream.synchronize()
+                else:
+                    target.copy_(tensor)
         return
 
-    import modules.default_pipeline as pipeline
+    # Interleaved shards keep the large and small tensors of each block spread over all threads.
+    shards = [list(range(i, len(items), threads)) for i in range(threads)]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(load_shard, shards))
+
+    for (current_key, _), target in zip(items, targets):
+        recursive_set(model, current_key, torch.nn.Parameter(target, requires_grad=False))
+    return
+
+
+def prefetch_from_virtual_memory(model):
+    # Starts loading the model back on a background thread if it is in virtual memory and fits next to what
+    # is resident now; load_from_virtual_memory then only waits for the part that is still missing.
+    job = prefetch_jobs.get(id(model), None)
+    if job is not None and not job[1].is_alive():
+        prefetch_jobs.pop(id(model), None)
+        job = None
+    if not isinstance(getattr(model, 'virtual_memory_dict', None), dict) or job is not None:
+        return False
 
+    model_file = getattr(model, 'model_file', {})
+    if model_file.get('original_device', 'cpu') == 'cpu':
+        free = model_management.get_free_memory(torch.device('cpu'))
+    else:
+        free = model_management.get_free_memory(model_management.get_torch_device())
+    size = getattr(model, 'virtual_memory_bytes', 0)
+    if free - size < policy_margin_bytes:
+        print(f'[Virtual Memory System] Prefetch skipped for {model_file.get("prefix", None)}: '
+              f'free = {free / 2**20:.0f} MB, size = {size / 2**20:.0f} MB')
+        return False
+
+    def run():
+        try:
+            load_from_virtual_memory(model)
+        except Exception as e:
+            print(f'[Virtual Memory System] Prefetch failed: {e}')
+
+    thread = threading.Thread(target=run, daemon=True)
+    prefetch_jobs[id(model)] = (model, thread, time.time())
+    thread.start()
+    print(f'[Virtual Memory System] Prefetch started for {model_file.get("prefix", None)}: {model_file.get("filename", None)}')
+    return True
+
+
+def wait_for_prefetch(model):
+    job = prefetch_jobs.get(id(model), None)
+    if job is None or job[0] is not model:
+        return
+    _, thread, started = job
+    timer = time.time()
+    thread.join()
+    prefetch_jobs.pop(id(model), None)
+    print(f'[Virtual Memory System] Prefetch started {timer - started:.2f}s before it was needed, '
+          f'waited {time.time() - timer:.2f}s for the rest')
+    return
+
+
+def model_bytes(model):
+    if isinstance(getattr(model, 'virtual_memory_dict', None), dict):
+        return getattr(model, 'virtual_memory_bytes', 0)
+    return sum(v.numel() * v.element_size() for v in model.state_dict().values())
+
+
+def free_bytes():
+    if 'cpu' in model_management.unet_offload_device().type.lower():
+        return model_management.get_free_memory(torch.device('cpu'))
+    return model_management.get_free_memory(model_management.get_torch_device())
+
+
+def reload_seconds(model):
+    speed = reload_speed.get(getattr(model, 'model_file', {}).get('filename', None), None)
+    if speed is None:
+        return None
+    return model_bytes(model) / speed
+
+
+def should_move_to_virtual_memory(model, pipeline):
+    # Returns (decision, reason).
     if pipeline.xl_refiner is None:
         # If users do not use refiner, no need to use this.
+        return False, 'no refiner'
+
+    is_refiner = model is pipeline.xl_refiner.unet.model or model is pipeline.xl_refiner.clip.cond_stage_model
+
+    if policy_mode == 'legacy':
+        return global_virtual_memory_activated, f'legacy, activated = {global_virtual_memory_activated}'
+    if policy_mode == 'keep_both':
+        return False, 'keep both resident'
+    if policy_mode == 'offload_refiner':
+        return is_refiner, 'offload refiner only'
+    if policy_mode == 'offload_all':
+        return True, 'offload everything'
+
+    # Models of the pipeline that are in virtual memory now are the ones that will be loaded back next.
+    pending = 0
+    for sd in [pipeline.xl_base, pipeline.xl_refiner]:
+        if sd is None:
+            continue
+        for m in [sd.unet.model if sd.unet is not None else None, sd.clip.cond_stage_model if sd.clip is not None else None]:
+            if m is not None and m is not model and isinstance(getattr(m, 'virtual_memory_dict', None), dict):
+                pending += getattr(m, 'virtual_memory_bytes', 0)
+
+    headroom = free_bytes() - pending
+    reload = reload_seconds(model)
+    reason = f'auto, free - pending = {headroom / 2**20:.0f} MB, margin = {policy_margin_bytes / 2**20:.0f} MB, ' \
+             f'size = {model_bytes(model) / 2**20:.0f} MB, reload = {"unknown" if reload is None else "%.2fs" % reload}'
+    if headroom < policy_margin_bytes:
+        return True, reason
+    if reload is not None and reload < policy_cheap_reload_seconds and headroom < 2 * policy_margin_bytes:
+        return True, reason
+    return False, reason
+
+
+@torch.no_grad()
+def try_move_to_virtual_memory(model, comfy_unload=True):
+    # A running prefetch deletes virtual_memory_dict when it finishes, so decide after it.
+    if id(model) in prefetch_jobs:
+        wait_for_prefetch(model)
+
+    if isinstance(getattr(model, 'virtual_memory_dict', None), dict):
+        # Already in virtual memory.
         return
 
-    move_to_virtual_memory(model, comfy_unload)
+    import modules.default_pipeline as pipeline
+
+    decision, reason = should_move_to_virtual_memory(model, pipeline)
+    prefix = getattr(model, 'model_file', {}).get('prefix', type(model).__name__)
+    print(f'[Virtual Memory System] Policy: {"offload" if decision else "keep"} {prefix} ({reason})')
+
+    if decision:
+        move_to_virtual_memory(model, comfy_unload)
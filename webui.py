@@ -40,31 +40,29 @@ def generate_clicked(*args):
         gr.update(value=None), \
         gr.update()
 
-    worker.buffer.append(list(args))
+    task = worker.submit(args)
     finished = False
 
     while not finished:
-        time.sleep(0.01)
-        if len(worker.outputs) > 0:
-            flag, product = worker.outputs.pop(0)
-            if flag == 'preview':
-                percentage, title, image = product
-                yield gr.update(visible=True, value=modules.html.make_progress_html(percentage, title)), \
-                    gr.update(visible=True, value=image) if image is not None else gr.update(), \
-                    gr.update(visible=False), \
-                    gr.update(), \
-                    gr.update(), \
-                    gr.update()
-            if flag == 'metadatas':
-                yield gr.update(), gr.update(), gr.update(), gr.update(), gr.update(value=product), gr.update(selected=GALLERY_ID_OUTPUT)
-            if flag == 'results':
-                yield gr.update(visible=False), \
-                    gr.update(visible=False), \
-                    gr.update(visible=True), \
-                    gr.update(value=product), \
-                    gr.update(), \
-                    gr.update()
-                finished = True
+        flag, product = task.get()  # blocks until the worker emits an event for this job
+        if flag == 'preview':
+            percentage, title, image = product
+            yield gr.update(visible=True, value=modules.html.make_progress_html(percentage, title)), \
+                gr.update(visible=True, value=image) if image is not None else gr.update(), \
+                gr.update(visible=False), \
+                gr.update(), \
+                gr.update(), \
+                gr.update()
+        if flag == 'metadatas':
+            yield gr.update(), gr.update(), gr.update(), gr.update(), gr.update(value=product), gr.update(selected=GALLERY_ID_OUTPUT)
+        if flag == 'results':
+            yield gr.update(visible=False), \
+                gr.update(visible=False), \
+                gr.update(visible=True), \
+                gr.update(value=product), \
+                gr.update(), \
+                gr.update()
+            finished = True
 
     execution_time = time.perf_counter() - execution_start_time
     print(f'Total time: {execution_time:.2f} seconds')
@@ -532,8 +530,8 @@ with shared.gradio_root:
 
             with gr.Tab(label='Models'):
                 with gr.Row():
-                    base_model = gr.Dropdown(label='SDXL Base Model', choices=modules.path.model_filenames, value=settings['base_model'], show_label=True)
-                    refiner_model = gr.Dropdown(label='SDXL Refiner', choices=['None'] + modules.path.model_filenames, value=settings['refiner_model'], show_label=True)
+                    base_model = gr.Dropdown(label='SDXL Base Model', choices=modules.path.base_model_filenames, value=settings['base_model'], show_label=True)
+                    refiner_model = gr.Dropdown(label='SDXL Refiner', choices=['None'] + modules.path.refiner_model_filenames, value=settings['refiner_model'], show_label=True)
                 with gr.Accordion(label='LoRAs', open=True):
                     lora_ctrls = []
                     for i in range(5):
@@ -572,7 +570,7 @@ with shared.gradio_root:
                 def model_refresh_clicked():
                     modules.path.update_all_model_names()
                     results = []
-                    results += [gr.update(choices=modules.path.model_filenames), gr.update(choices=['None'] + modules.path.model_filenames)]
+                    results += [gr.update(choices=modules.path.base_model_filenames), gr.update(choices=['None'] + modules.path.refiner_model_filenames)]
                     for i in range(5):
                         results += [gr.update(choices=['None'] + modules.path.lora_filenames), gr.update()]
                     return results